@@ -1,13 +1,16 @@
 import os
 import uvicorn
 from app.core.config import settings
-from app.core.application import get_app
 from app.core.gunicorn_runner import GunicornApplication
+from app.ml_models_utils.model_export import prepare_exports
+from app.utils.metrics_utils import reset_metrics_dir
 
 
 
 def main() -> None:
     """Entrypoint of the application."""
+    # metrics of a previous run would be merged with this one
+    reset_metrics_dir(settings.METRICS_DIR)
     if settings.reload:
         uvicorn.run(
             "app.core.application:get_app",
@@ -21,6 +24,11 @@ def main() -> None:
     else:
         # gunicorn in production for better stability
         # reload is off,
+        if settings.SHARED_WEIGHTS:
+            # the workers map the same export files, built once here.
+            # OPTIMIZED_RUNTIME workers export on their first load instead,
+            # once per model under the file lock, so the port binds at once
+            prepare_exports()
         GunicornApplication(
             "app.core.application:get_app",
             host=settings.host,
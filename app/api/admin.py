@@ -0,0 +1,58 @@
+import os
+import time
+import secrets
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from app.core.config import settings
+from app.schemas.admin_scheme import LoopMonitorRequest
+from app.utils.custom_exceptions import ProfilerBusyError
+from app.utils.profiling_utils import profiler, loop_lag_monitor
+
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN.")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, settings.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+
+router = APIRouter(dependencies=[Depends(require_admin_token)])
+
+
+@router.post("/profile", response_class=PlainTextResponse)
+async def profile_worker(
+    seconds: float = Query(10.0, gt=0),
+    interval_ms: float = Query(10.0, ge=1),
+):
+    """
+    Sample the stacks of the worker serving this request for ``seconds``.
+
+    Returns collapsed stacks, one ``frame;frame;... count`` line per
+    stack, to feed to flamegraph.pl or speedscope. Only the worker that
+    got the request is profiled, its pid is in the X-Worker-Pid header.
+    """
+    seconds = min(seconds, settings.PROFILER_MAX_SECONDS)
+    try:
+        collapsed = await profiler.profile(seconds, interval_ms / 1000)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    filename = f"profile-{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}.collapsed"
+    return PlainTextResponse(collapsed, headers={
+        "X-Worker-Pid": str(os.getpid()),
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
+
+
+@router.get("/loop_monitor")
+async def loop_monitor_status():
+    """Event loop lag monitor of the worker serving this request."""
+    return {"pid": os.getpid(), **loop_lag_monitor.status()}
+
+
+@router.post("/loop_monitor")
+async def configure_loop_monitor(request: LoopMonitorRequest):
+    """Change the blocking threshold of this worker's loop monitor, 0 stops it."""
+    await loop_lag_monitor.stop()
+    loop_lag_monitor.start(request.threshold_ms)
+    return {"pid": os.getpid(), **loop_lag_monitor.status()}
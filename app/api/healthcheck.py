@@ -1,7 +1,33 @@
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from app.utils.model_utils import model_manager
+from app.ml_models_utils.model_manager import startup_timings
+from app.utils import cpu_utils
 
 router = APIRouter()
 
 @router.get("/health")
 async def healthcheck():
-    return {"status": "OK"}
+    return {"status": "OK", "models": model_manager.model_status}
+
+
+@router.get("/ready")
+async def readiness():
+    """
+    Readiness of this worker, with the loading state of each model.
+
+    Returns 503 until at least one model is ready, so the instance can take
+    traffic for the models that already loaded while the rest are loading.
+    Models are reported ready once they are warmed up. The timings are
+    per model (download, load, warm-up) and per worker (imports, preload),
+    with the CPU layout of the worker.
+    """
+    ready_models = model_manager.ready_models()
+    content = {
+        "ready": bool(ready_models),
+        "models": model_manager.model_status,
+        "timings": model_manager.load_timings,
+        "startup": startup_timings,
+        "cpu": cpu_utils.worker_layout.as_dict() if cpu_utils.worker_layout else None,
+    }
+    return JSONResponse(content=content, status_code=200 if ready_models else 503)
@@ -1,23 +1,87 @@
-from fastapi import APIRouter, HTTPException
-from app.schemas.inference_scheme import InferenceRequest, InferenceResponse
-from app.services.model_inference import run_inference_service
-from app.utils.custom_exceptions import ModelNotFoundError, ImageProcessingError
+from typing import Optional
+from fastapi import APIRouter, HTTPException, File, Form, UploadFile
+from fastapi.responses import StreamingResponse
+from app.schemas.inference_scheme import InferenceRequest, InferenceResponse, BatchInferenceRequest, BatchInferenceResponse, StreamInferenceRequest
+from app.services.model_inference import run_inference_service, run_batch_inference_service, stream_inference_service, run_upload_inference_service
+from app.core.config import settings
+from app.utils.custom_exceptions import ModelNotFoundError, ImageProcessingError, ImageTooLargeError, ServiceOverloadedError
 
 router = APIRouter()
 
-@router.post("/predict", response_model=InferenceResponse)
+
+def _overloaded(error: ServiceOverloadedError) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": str(error.retry_after)})
+
+
+@router.post("/predict", response_model=InferenceResponse, response_model_exclude_none=True)
 async def run_inference(request: InferenceRequest):
     try:
-        result = await run_inference_service(request.model_name.lower(), request.presigned_url)
+        result = await run_inference_service(request.model_name.lower(), request.presigned_url, request.top_k)
         if not result:
             raise HTTPException(status_code=500, detail="inference failed.")        
         return result
+    except ServiceOverloadedError as e:
+        raise _overloaded(e)
     except ModelNotFoundError as e:
         raise HTTPException(status_code=503, detail=f"Model not available, try to reload. details {str(e)}")
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except ImageProcessingError as e:
         raise HTTPException(status_code=422, detail=str(e))
     else:
         raise HTTPException(status_code=500)
 
 
+@router.post("/predict_upload", response_model=InferenceResponse, response_model_exclude_none=True)
+async def run_upload_inference(
+    model_name: str = Form(...), file: UploadFile = File(...), top_k: Optional[int] = Form(None, ge=1),
+):
+    """
+    Run inference on an image uploaded as multipart form data.
+
+    Skips the S3 round trip of /predict. The upload is spooled to disk
+    past a small size and decoded straight from the spooled file.
+    """
+    if file.size is not None and file.size > settings.IMAGE_MAX_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is {file.size} bytes, the limit is {settings.IMAGE_MAX_BYTES} bytes.",
+        )
+    try:
+        return await run_upload_inference_service(model_name.lower(), file.file, top_k)
+    except ServiceOverloadedError as e:
+        raise _overloaded(e)
+    except ModelNotFoundError as e:
+        raise HTTPException(status_code=503, detail=f"Model not available, try to reload. details {str(e)}")
+    except ImageProcessingError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    finally:
+        await file.close()
+
+
+@router.post("/predict_batch", response_model=BatchInferenceResponse)
+async def run_batch_inference(request: BatchInferenceRequest):
+    """
+    Run inference over many images in one call.
+
+    Each item gets its own result or error, with the status code the
+    single-image endpoint would have returned for it.
+    """
+    results = await run_batch_inference_service(request.items)
+    return BatchInferenceResponse(results=results)
+
+
+@router.post("/predict_stream")
+async def run_stream_inference(request: StreamInferenceRequest):
+    """
+    Run inference over a large job, streaming one JSON line per image.
+
+    Lines are written as soon as each image finishes, in completion
+    order, each with the ``index`` of its item. If the client disconnects,
+    the remaining images are cancelled.
+    """
+    async def _lines():
+        async for item in stream_inference_service(request.items):
+            yield item.model_dump_json() + "\n"
 
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
@@ -0,0 +1,17 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.utils.metrics_utils import metrics
+
+router = APIRouter()
+
+
+@router.get("", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Metrics of all the gunicorn workers, in the Prometheus text format.
+
+    Counters and histograms are summed over the workers, gauges are
+    reported per worker. The other workers' values are at most
+    METRICS_FLUSH_INTERVAL seconds old.
+    """
+    return PlainTextResponse(metrics.collect(), media_type="text/plain; version=0.0.4")
@@ -1,11 +1,30 @@
 from fastapi import APIRouter, HTTPException
 from app.utils.model_utils import model_manager
+from app.core.config import settings
+from app.utils.utils import version_index
 from app.utils.custom_exceptions import ModelLoadingError
 from app.schemas.models_scheme import ModelReloadRequest
+from app.services.model_inference import invalidate_model_predictions
+from app.services.model_sync import publish_reload
 
 
 router = APIRouter()
 
+@router.get("/", status_code=200)
+async def list_models():
+    """
+    Models resident in this worker, least recently used first,
+    and the loading state of every model, with the version index of
+    the downloaded weights.
+    """
+    return {
+        "resident": model_manager.resident_models(),
+        "resident_mb": round(model_manager.resident_bytes() / 2**20, 2),
+        "budget_mb": settings.MODEL_MEMORY_BUDGET_MB,
+        "models": model_manager.model_status,
+        "weights": version_index.entries(),
+    }
+
 @router.post("/reload", status_code=200)
 async def reload_model(request: ModelReloadRequest):
     #check if model_name is correct
@@ -13,7 +32,10 @@ async def reload_model(request: ModelReloadRequest):
         raise HTTPException(status_code=503, detail=f"Model name is not found in class list.")
 
     try:
-        result = await model_manager._load_model_from_s3(request.model_name)
+        # hot swap, requests keep being served by the current version meanwhile
+        result = await model_manager.reload_model(request.model_name)
+        invalidate_model_predictions(request.model_name.lower())
+        publish_reload(request.model_name.lower())
         return(f"Model {request.model_name} loaded successfully")
     except ModelLoadingError as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,9 +1,13 @@
+import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.inference import router as inference_router
 from app.api.healthcheck import router as healthcheck_router
 from app.api.ml_models import router as models_router
+from app.api.metrics import router as metrics_router
+from app.api.admin import router as admin_router
 from app.core.lifetime import register_startup_event, register_shutdown_event
+from app.core.config import settings
 
 def get_app() -> FastAPI:
     """
@@ -11,6 +15,10 @@ def get_app() -> FastAPI:
     This is the main constructor of an application.
     :return: application.
     """
+    logging.basicConfig(
+        level=settings.log_level.value,
+        format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+    )
     app = FastAPI(
         title="Pest Identification ML API",
         version="1.0.0",
@@ -38,6 +46,9 @@ def get_app() -> FastAPI:
     app.include_router(inference_router, prefix="/api/inference", tags=["Inference"])
     app.include_router(healthcheck_router, prefix="/api/healthcheck", tags=["Healthcheck"])
     app.include_router(models_router, prefix="/api/models", tags=["Models"])
+    app.include_router(metrics_router, prefix="/api/metrics", tags=["Metrics"])
+    # profiler and event loop monitor, behind ADMIN_TOKEN
+    app.include_router(admin_router, prefix="/api/admin", tags=["Admin"])
 
     
 
@@ -1,5 +1,7 @@
 import enum
 import os
+import tempfile
+from typing import Dict, List, Literal, Optional
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 class LogLevel(str, enum.Enum):
@@ -40,10 +42,184 @@ class Settings(BaseSettings):
     AWS_SECRET_ACCESS_KEY: str = Field(..., env="AWS_SECRET_ACCESS_KEY")
     AWS_WEIGHTS_BUCKET_NAME: str = Field(..., env="AWS_WEIGHTS_BUCKET_NAME")
     AWS_IMAGES_BUCKET_NAME: str = Field(..., env="AWS_IMAGES_BUCKET_NAME")
+    # S3 compatible endpoint, e.g. a local stand-in, AWS when not set
+    AWS_ENDPOINT_URL: Optional[str] = None
+
+    #Execution stages
+    # bounded thread pools for the blocking parts of a request,
+    # image decode/preprocess and model.predict respectively
+    PREPROCESS_THREADS: int = 4
+    INFERENCE_THREADS: int = 2
+
+    #CPU topology
+    # each worker gets CPU_CORES_PER_WORKER cores, 0 splits the cores of
+    # the box evenly across workers_count workers, and is pinned to them
+    # with CPU_PIN_WORKERS. TensorFlow (and oneDNN) threads are sized to
+    # the worker's cores unless TF_INTRA_OP_THREADS is set, 0 means auto
+    CPU_CORES_PER_WORKER: int = 0
+    CPU_PIN_WORKERS: bool = False
+    TF_INTRA_OP_THREADS: int = 0
+    TF_INTER_OP_THREADS: int = 0
+
+    #Image fetching
+    # shared HTTP client used for presigned URL downloads,
+    # timeouts are in seconds
+    HTTP_POOL_SIZE: int = 100
+    HTTP_POOL_SIZE_PER_HOST: int = 20
+    HTTP_KEEPALIVE_TIMEOUT: float = 30.0
+    HTTP_CONNECT_TIMEOUT: float = 5.0
+    HTTP_READ_TIMEOUT: float = 20.0
+    HTTP_CHUNK_SIZE: int = 64 * 1024
+    IMAGE_MAX_BYTES: int = 20 * 1024 * 1024
+
+    #Image preprocessing
+    # decode JPEGs at a reduced scale (still >= the model input size)
+    # instead of at full resolution before resizing
+    JPEG_DRAFT_DECODE: bool = True
+
+    #Postprocessing
+    # a softmax prediction whose top class is below this confidence is
+    # reported as "healthy"
+    HEALTHY_CONFIDENCE_THRESHOLD: float = 0.6
+
+    #Dynamic batching
+    # concurrent requests for the same model are grouped
+    # into one forward pass of up to BATCH_MAX_SIZE images,
+    # waiting at most BATCH_MAX_WAIT_MS for the batch to fill
+    BATCH_MAX_SIZE: int = 16
+    BATCH_MAX_WAIT_MS: float = 10.0
+
+    #Admission control
+    # per model, at most ADMISSION_MAX_CONCURRENCY requests are processed
+    # at once (0 disables admission control) and at most
+    # ADMISSION_MAX_QUEUE wait for a slot. A request is rejected with 503
+    # and Retry-After when the queue is full, when its expected wait is
+    # longer than ADMISSION_DEADLINE_MS, or once it waited that long
+    # (0 means no deadline). Keep the deadline under the proxy timeout.
+    ADMISSION_MAX_CONCURRENCY: int = 32
+    ADMISSION_MAX_QUEUE: int = 64
+    ADMISSION_DEADLINE_MS: float = 5000.0
+
+    #Batch endpoint
+    # /api/inference/predict_batch accepts up to BATCH_REQUEST_MAX_ITEMS
+    # images and processes at most BATCH_FETCH_CONCURRENCY of them at once,
+    # each holding an admission slot of its model
+    BATCH_REQUEST_MAX_ITEMS: int = 500
+    BATCH_FETCH_CONCURRENCY: int = 32
+    # /api/inference/predict_stream accepts larger jobs, keeping at most
+    # STREAM_MAX_IN_FLIGHT images in memory at once
+    STREAM_REQUEST_MAX_ITEMS: int = 20000
+    STREAM_MAX_IN_FLIGHT: int = 32
+
+    #Prediction cache
+    # results keyed on (model, model version, image hash),
+    # PREDICTION_CACHE_SIZE=0 disables the cache, TTL is in seconds
+    PREDICTION_CACHE_SIZE: int = 10000
+    PREDICTION_CACHE_TTL: float = 3600.0
+
+    #Image cache
+    # preprocessed images keyed on the S3 object of their presigned URL
+    # (the signature is ignored), for URLs of AWS S3 or of AWS_ENDPOINT_URL
+    # only. Each request still sends its own URL, as a conditional GET on
+    # the cached ETag, so retries and other models run over the same image
+    # skip the download and the decode, not the check by S3.
+    # IMAGE_CACHE_MAX_BYTES bounds the memory of each worker (0 disables
+    # the cache). IMAGE_CACHE_DIR adds a disk cache shared by the workers,
+    # of at most IMAGE_CACHE_DISK_MAX_BYTES.
+    IMAGE_CACHE_MAX_BYTES: int = 128 * 1024 * 1024
+    IMAGE_CACHE_DIR: str = ""
+    IMAGE_CACHE_DISK_MAX_BYTES: int = 1024 * 1024 * 1024
+
+    #Model loading
+    # weights are downloaded and models loaded concurrently at startup,
+    # downloads are checked against the S3 object size and ETag
+    MODEL_DOWNLOAD_CONCURRENCY: int = 4
+    MODEL_LOAD_THREADS: int = 2
+    VERIFY_WEIGHTS_CHECKSUM: bool = True
+
+    #Warm-up
+    # every model runs a synthetic batch of each of these sizes when it
+    # loads, before it is reported ready, so graph tracing and buffer
+    # allocation do not land on the first requests ([] disables it).
+    # Add BATCH_MAX_SIZE when batches are usually full. TFLite models
+    # warm up each of their RUNTIME_BATCH_SIZES instead.
+    MODEL_WARMUP_BATCH_SIZES: List[int] = [1]
+
+    #Weights download
+    # objects larger than S3_PART_SIZE are fetched as ranged parts,
+    # S3_PART_CONCURRENCY at a time, into a temp file renamed once it is
+    # verified. An interrupted download resumes from its finished parts.
+    S3_PART_SIZE: int = 8 * 1024 * 1024
+    S3_PART_CONCURRENCY: int = 8
+    S3_MAX_POOL_CONNECTIONS: int = 32
+
+    #Model residency
+    # with MODEL_LAZY_LOADING models load on their first request,
+    # least recently used models are evicted once the resident weights
+    # exceed MODEL_MEMORY_BUDGET_MB (0 means no limit),
+    # PINNED_MODELS always load at startup and are never evicted
+    MODEL_LAZY_LOADING: bool = False
+    MODEL_MEMORY_BUDGET_MB: int = 0
+    PINNED_MODELS: List[str] = []
+
+    #Shared weights
+    # serve models from TFLite exports memory-mapped read-only by all
+    # gunicorn workers, instead of one private Keras copy per worker.
+    # The exports are built once in a separate process before the
+    # workers start, and rebuilt when the weights change.
+    SHARED_WEIGHTS: bool = False
+
+    #Optimized runtime
+    # serve models from a TFLite export run with the XNNPACK delegate,
+    # instead of Keras predict. The export is checked against the Keras
+    # model when it is built and only served if the outputs match within
+    # RUNTIME_PARITY_TOLERANCE, otherwise the Keras model is served.
+    # RUNTIME_NUM_THREADS is the threads of each TFLite interpreter, 0
+    # splits the worker's cores between its INFERENCE_THREADS
+    OPTIMIZED_RUNTIME: bool = True
+    RUNTIME_PARITY_TOLERANCE: float = 1e-3
+    RUNTIME_NUM_THREADS: int = 0
+    # TFLite batches are padded up to the next of RUNTIME_BATCH_SIZES
+    # (default: the powers of two up to BATCH_MAX_SIZE), each size with
+    # its own interpreter allocated and warmed up when the model loads,
+    # instead of reallocating whenever the batch size changes. With
+    # XNNPACK, each of them also holds a packed copy of the weights
+    RUNTIME_BATCH_SIZES: List[int] = []
+
+    #Quantization
+    # post-training quantization of the TFLite export, per model:
+    # "int8" (dynamic range) or "float16", e.g.
+    # ML_APIS_MODEL_QUANTIZATION='{"tomato": "int8"}'. Applies to
+    # OPTIMIZED_RUNTIME and SHARED_WEIGHTS. Measure the accuracy cost
+    # first with python -m app.ml_models_utils.quantization_report
+    MODEL_QUANTIZATION: Dict[str, Literal["int8", "float16"]] = {}
+
+    #Model reloads
+    # a reload served by one worker is published in RELOAD_EVENTS_PATH,
+    # the other workers poll it every MODEL_SYNC_INTERVAL seconds
+    # (0 disables it) and hot swap the model from the local weights
+    MODEL_SYNC_INTERVAL: float = 2.0
+
+    #Metrics
+    # each worker saves its metrics to METRICS_DIR every
+    # METRICS_FLUSH_INTERVAL seconds, /api/metrics merges all workers
+    METRICS_DIR: str = os.path.join(tempfile.gettempdir(), "ml_apis_metrics")
+    METRICS_FLUSH_INTERVAL: float = 5.0
+
+    #Profiling
+    # /api/admin endpoints need an X-Admin-Token header matching
+    # ADMIN_TOKEN, they are disabled when it is not set
+    ADMIN_TOKEN: Optional[str] = None
+    PROFILER_MAX_SECONDS: float = 60.0
+    # log the stack of callbacks blocking the event loop for longer than
+    # LOOP_LAG_THRESHOLD_MS (0 disables it), can be changed at runtime
+    # with /api/admin/loop_monitor
+    LOOP_LAG_THRESHOLD_MS: float = 200.0
 
     #Weights [absolute path]
     WEIGHTS_DIR: str = os.path.join(os.path.dirname(__file__), "../weights")
     VERSIONS_PATH: str = os.path.join(os.path.dirname(__file__), "../weights/versions.json")
+    RELOAD_EVENTS_PATH: str = os.path.join(os.path.dirname(__file__), "../weights/reload_events.json")
 
     # model_config = SettingsConfigDict(
     #     env_file=os.path.join(os.path.dirname(__file__), "../.env"),
@@ -1,3 +1,4 @@
+import itertools
 from typing import Any
 
 from gunicorn.app.base import BaseApplication
@@ -24,6 +25,19 @@ class UvicornWorker(BaseUvicornWorker):
     }
 
 
+def pre_fork(server, worker) -> None:
+    """Give a new worker the lowest CPU slot no live worker holds."""
+    taken = {getattr(other, "cpu_slot", None) for other in server.WORKERS.values()}
+    worker.cpu_slot = next(slot for slot in itertools.count() if slot not in taken)
+
+
+def post_fork(server, worker) -> None:
+    """Apply the CPU layout of the worker, before the app is imported."""
+    from app.utils.cpu_utils import configure_worker
+
+    configure_worker(worker.cpu_slot, server.num_workers)
+
+
 class GunicornApplication(BaseApplication):
     """
     Custom gunicorn application.
@@ -44,6 +58,9 @@ class GunicornApplication(BaseApplication):
             "bind": f"{host}:{port}",
             "workers": workers,
             "worker_class": "app.core.gunicorn_runner.UvicornWorker",
+            # a restarted worker takes the cores of the one it replaces
+            "pre_fork": pre_fork,
+            "post_fork": post_fork,
             **kwargs,
         }
         self.app = app
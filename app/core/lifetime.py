@@ -1,6 +1,16 @@
+import asyncio
 from typing import Awaitable, Callable
 from fastapi import FastAPI
-from app.utils.model_utils import preload_models
+from app.utils.model_utils import load_classes, preload_models
+from app.services.model_inference import batch_scheduler
+from app.utils.executor_utils import shutdown_executors
+from app.utils.http_utils import http_client
+from app.utils.s3_utils import s3_client
+from app.services.model_sync import model_sync_watcher
+from app.utils.metrics_utils import metrics
+from app.utils.profiling_utils import loop_lag_monitor
+from app.utils import cpu_utils
+from app.core.config import settings
 def register_startup_event(
     app: FastAPI,
 ) -> Callable[[], Awaitable[None]]:  # pragma: no cover
@@ -13,7 +23,18 @@ def register_startup_event(
     async def _startup() -> None:
         app.middleware_stack = None
         app.middleware_stack = app.build_middleware_stack()
-        classes = await preload_models()
+        if cpu_utils.worker_layout is None:
+            # not forked by gunicorn (uvicorn reload mode, tests)
+            cpu_utils.configure_worker()
+        cpu_utils.log_layout()
+        await http_client.start()
+        classes = await load_classes()
+        # models load in the background, each one serves as soon as it is ready
+        app.state.preload_task = asyncio.create_task(preload_models())
+        # pick up reloads served by the other workers
+        model_sync_watcher.start()
+        metrics.start(settings.METRICS_FLUSH_INTERVAL)
+        loop_lag_monitor.start()
     return _startup
 
 
@@ -27,5 +48,14 @@ def register_shutdown_event(
     """
     @app.on_event("shutdown")
     async def _shutdown() -> None:
-        pass
+        preload_task = getattr(app.state, "preload_task", None)
+        if preload_task is not None and not preload_task.done():
+            preload_task.cancel()
+        await model_sync_watcher.stop()
+        await metrics.stop()
+        await loop_lag_monitor.stop()
+        await batch_scheduler.shutdown()
+        shutdown_executors()
+        await http_client.close()
+        await s3_client.close()
     return _shutdown
\ No newline at end of file
@@ -0,0 +1,340 @@
+import os
+import json
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+from typing import Dict, List, Optional, Sequence
+from app.core.config import settings
+from app.utils.utils import file_lock, version_index
+
+logger = logging.getLogger(__name__)
+
+
+def _source_fingerprint(source_path: str, version: Optional[str]) -> dict:
+    stat = os.stat(source_path)
+    return {"version": version, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def model_quantization(model_name: str) -> Optional[str]:
+    """Quantization mode configured for a model, None for full precision."""
+    return settings.MODEL_QUANTIZATION.get(model_name.lower())
+
+
+def tflite_path(source_path: str, quantization: Optional[str] = None) -> str:
+    suffix = f".{quantization}.tflite" if quantization else ".tflite"
+    return os.path.splitext(source_path)[0] + suffix
+
+
+def is_export_current(source_path: str, version: Optional[str], quantization: Optional[str] = None) -> bool:
+    """
+    Check that the exported model was built from the current weight file.
+
+    :param source_path: path of the .h5 weight file.
+    :param version: S3 version of the weight file.
+    :param quantization: quantization mode of the export.
+    """
+    target_path = tflite_path(source_path, quantization)
+    meta = export_metadata(target_path)
+    if not os.path.exists(target_path) or "parity" not in meta:
+        return False
+    return meta.get("source") == _source_fingerprint(source_path, version)
+
+
+def export_metadata(target_path: str) -> dict:
+    try:
+        with open(target_path + ".json", "r") as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def check_parity(model, flatbuffer: bytes, samples: int = 4) -> dict:
+    """
+    Compare the outputs of a TFLite export with the Keras model it was
+    built from, on a fixed batch of random images.
+
+    :param model: the Keras model.
+    :param flatbuffer: the converted model.
+    :param samples: number of images compared.
+    :return: largest absolute output difference and top-1 agreement.
+    """
+    import numpy as np
+
+    shape = (samples,) + tuple(model.input_shape[1:])
+    batch = np.random.default_rng(0).random(shape, dtype=np.float32)
+    expected = np.asarray(model.predict(batch, batch_size=samples, verbose=0))
+    actual = TFLiteModel(flatbuffer=flatbuffer).predict(batch)
+    return {
+        "max_abs_diff": float(np.max(np.abs(expected - actual))),
+        "top1_agreement": float(np.mean(np.argmax(expected, axis=-1) == np.argmax(actual, axis=-1))),
+    }
+
+
+def passes_parity(target_path: str, tolerance: float) -> bool:
+    """
+    Check the parity recorded when the export was built.
+
+    :param target_path: path of the .tflite file.
+    :param tolerance: largest accepted absolute output difference.
+    """
+    parity = export_metadata(target_path).get("parity")
+    if not parity:
+        return False
+    return parity["max_abs_diff"] <= tolerance and parity["top1_agreement"] == 1.0
+
+
+def _convert(saved_model_dir: str, quantization: Optional[str]) -> bytes:
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    if quantization == "int8":
+        # dynamic range: int8 weights, activations quantized on the fly,
+        # so no calibration data is needed
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization is not None:
+        raise ValueError(f"Unknown quantization mode {quantization}")
+    return converter.convert()
+
+
+def _export(source_path: str, target_path: str, version: Optional[str], quantization: Optional[str]) -> None:
+    import tensorflow as tf
+
+    logger.info("Exporting %s to %s", source_path, target_path)
+    model = tf.keras.models.load_model(source_path, compile=False)
+    # converting through a SavedModel, from_keras_model fails on Keras 3 models
+    with tempfile.TemporaryDirectory() as saved_model_dir:
+        model.export(saved_model_dir)
+        flatbuffer = _convert(saved_model_dir, quantization)
+    parity = check_parity(model, flatbuffer)
+    logger.info(
+        "Export of %s: max abs diff %.2e, top-1 agreement %.2f",
+        source_path, parity["max_abs_diff"], parity["top1_agreement"],
+    )
+
+    temp_path = f"{target_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as out_file:
+        out_file.write(flatbuffer)
+    os.replace(temp_path, target_path)
+    with open(target_path + ".json", "w") as meta_file:
+        json.dump({"source": _source_fingerprint(source_path, version), "parity": parity}, meta_file)
+
+
+def export_tflite(source_path: str, version: Optional[str] = None, quantization: Optional[str] = None) -> str:
+    """
+    Convert a Keras .h5 model to a TFLite flatbuffer next to it.
+
+    The conversion runs once per weight version: workers racing on the
+    same model wait on a file lock and reuse the first export. The file
+    is written to a temp path and renamed, so workers that still map the
+    previous export keep a valid file. The outputs of the export are
+    compared with the Keras model and the result is kept in the sidecar
+    metadata file, see ``passes_parity``. The status of the export is
+    recorded in the version index.
+
+    :param source_path: path of the .h5 weight file.
+    :param version: S3 version of the weight file.
+    :param quantization: "int8", "float16" or None for full precision.
+    :return: path of the .tflite file.
+    """
+    target_path = tflite_path(source_path, quantization)
+    # the weights of a model are <weights>/models/<name>/<name>_model.h5
+    model_name = os.path.basename(os.path.dirname(source_path))
+    artifact = f"tflite.{quantization}" if quantization else "tflite"
+    with file_lock(target_path + ".lock"):
+        if not is_export_current(source_path, version, quantization):
+            try:
+                _export(source_path, target_path, version, quantization)
+            except Exception as e:
+                version_index.set_artifact(model_name, artifact, status="failed", version=version, error=str(e))
+                raise
+    version_index.set_artifact(
+        model_name, artifact, status="ready", version=version, parity=export_metadata(target_path).get("parity"),
+    )
+    return target_path
+
+
+def runtime_batch_sizes() -> List[int]:
+    """
+    Batch sizes TFLite batches are padded to: RUNTIME_BATCH_SIZES, or
+    the powers of two up to BATCH_MAX_SIZE, and BATCH_MAX_SIZE itself.
+    """
+    if settings.RUNTIME_BATCH_SIZES:
+        return sorted(set(size for size in settings.RUNTIME_BATCH_SIZES if size > 0))
+    max_size = max(1, settings.BATCH_MAX_SIZE)
+    sizes = {max_size}
+    size = 1
+    while size < max_size:
+        sizes.add(size)
+        size *= 2
+    return sorted(sizes)
+
+
+class TFLiteModel:
+    """
+    Model served by the TFLite interpreter.
+
+    It exposes the subset of the Keras model API used by the inference
+    service, without the per-call overhead of Keras predict. Calls must be
+    serialized, like Keras predict calls on the same model.
+
+    By default the interpreter maps the flatbuffer instead of copying it,
+    and the XNNPACK delegate (which would repack the weights into private
+    memory) is disabled, so every worker shares the same weight pages
+    through the page cache. With ``use_xnnpack`` the delegate is enabled,
+    trading that sharing for faster CPU kernels.
+
+    Resizing the input and reallocating the tensors costs more than a
+    small forward pass, and micro-batches change size on most calls.
+    With ``batch_sizes``, a batch is padded up to the next of these sizes
+    and each size keeps its own allocated interpreter (with XNNPACK, its
+    own packed weights too). Without, a single interpreter is resized
+    whenever the batch size changes.
+    """
+
+    def __init__(
+        self,
+        model_path: Optional[str] = None,
+        use_xnnpack: bool = False,
+        num_threads: Optional[int] = None,
+        flatbuffer: Optional[bytes] = None,
+        batch_sizes: Sequence[int] = (),
+    ) -> None:
+        self.model_path = model_path
+        self.use_xnnpack = use_xnnpack
+        self.batch_sizes = sorted(set(batch_sizes))
+        self._file_bytes = os.path.getsize(model_path) if model_path else len(flatbuffer)
+        self._num_threads = num_threads
+        self._flatbuffer = flatbuffer
+        self.weights = []
+        # interpreters by allocated batch size
+        self._interpreters: Dict[int, object] = {}
+        interpreter = self._new_interpreter()
+        self._input = interpreter.get_input_details()[0]
+        self._output = interpreter.get_output_details()[0]
+        self._spare = interpreter
+        self._batch_size = None
+
+    def _new_interpreter(self):
+        import tensorflow as tf
+
+        if self.use_xnnpack:
+            op_resolver_type = tf.lite.experimental.OpResolverType.AUTO
+        else:
+            op_resolver_type = tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        return tf.lite.Interpreter(
+            model_path=self.model_path,
+            model_content=self._flatbuffer,
+            num_threads=self._num_threads,
+            experimental_op_resolver_type=op_resolver_type,
+        )
+
+    @property
+    def input_shape(self) -> tuple:
+        return tuple(None if dim < 0 else int(dim) for dim in self._input["shape_signature"])
+
+    @property
+    def size_bytes(self) -> int:
+        # mapped weights are shared, XNNPACK packs a copy per interpreter
+        if self.use_xnnpack:
+            return self._file_bytes * max(1, len(self._interpreters))
+        return self._file_bytes
+
+    def _allocated(self, batch_size: int):
+        interpreter = self._interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = self._spare or self._new_interpreter()
+            self._spare = None
+            shape = [batch_size] + [int(dim) for dim in self._input["shape"][1:]]
+            interpreter.resize_tensor_input(self._input["index"], shape)
+            interpreter.allocate_tensors()
+            # the padding rows are never written, they must hold finite values
+            interpreter.tensor(self._input["index"])()[:] = 0
+            self._interpreters[batch_size] = interpreter
+        return interpreter
+
+    def predict(self, batch, batch_size=None, verbose=0):
+        size = len(batch)
+        padded_size = next((bucket for bucket in self.batch_sizes if bucket >= size), None)
+        if padded_size is None:
+            # no fixed sizes, or a batch larger than all of them
+            return self._predict_resized(batch)
+        interpreter = self._allocated(padded_size)
+        interpreter.tensor(self._input["index"])()[:size] = batch
+        interpreter.invoke()
+        return interpreter.get_tensor(self._output["index"])[:size]
+
+    def _predict_resized(self, batch):
+        interpreter = self._interpreters.get(-1)
+        if interpreter is None:
+            interpreter = self._interpreters[-1] = self._spare or self._new_interpreter()
+            self._spare = None
+        if len(batch) != self._batch_size:
+            interpreter.resize_tensor_input(self._input["index"], list(batch.shape))
+            interpreter.allocate_tensors()
+            self._batch_size = len(batch)
+        interpreter.set_tensor(self._input["index"], batch)
+        interpreter.invoke()
+        return interpreter.get_tensor(self._output["index"])
+
+
+async def _export_all_models() -> None:
+    from app.utils.model_utils import load_classes, model_manager
+    from app.utils.s3_utils import s3_client, s3_manifest
+    from app.utils.utils import get_model_version
+
+    try:
+        await load_classes()
+        try:
+            listed = await s3_manifest.refresh(settings.AWS_WEIGHTS_BUCKET_NAME, "models/")
+            logger.info("Listed %d weight files in %s", listed, settings.AWS_WEIGHTS_BUCKET_NAME)
+        except Exception as e:
+            logger.warning("Listing %s failed, checking each model instead: %s", settings.AWS_WEIGHTS_BUCKET_NAME, e)
+        semaphore = asyncio.Semaphore(max(1, settings.MODEL_DOWNLOAD_CONCURRENCY))
+        # a conversion takes all the cores, they run one at a time
+        # while the other models keep downloading
+        export_lock = asyncio.Lock()
+
+        async def _export_model(model_name: str):
+            model_name = model_name.lower()
+            try:
+                await model_manager.download_model(model_name, download_limiter=semaphore)
+                async with export_lock:
+                    await asyncio.to_thread(
+                        export_tflite,
+                        model_manager.model_file_path(model_name),
+                        get_model_version(model_name),
+                        model_quantization(model_name),
+                    )
+            except Exception as e:
+                logger.error("Failed to export model %s: %s", model_name, e)
+
+        await asyncio.gather(*[_export_model(name) for name in model_manager.class_dict.keys()])
+        s3_manifest.clear()
+    finally:
+        await s3_client.close()
+
+
+def _export_all_models_process() -> None:
+    logging.basicConfig(level=settings.log_level.value)
+    asyncio.run(_export_all_models())
+
+
+def prepare_exports() -> None:
+    """
+    Download and export every model once, before the workers are forked,
+    for SHARED_WEIGHTS. The models are downloaded concurrently, checked
+    against one listing of the bucket.
+
+    Runs in a spawned process so TensorFlow is never initialised in the
+    gunicorn master. If it fails, each worker exports what it needs on
+    its own, still once per model thanks to the file lock.
+    """
+    process = multiprocessing.get_context("spawn").Process(target=_export_all_models_process)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        logger.warning("Model export preparation exited with code %s", process.exitcode)
@@ -1,56 +1,414 @@
 import os
+import time
+import logging
 import aioboto3
 from app.core.config import settings
 from fastapi import HTTPException
-from functools import lru_cache
+from collections import OrderedDict
 from app.utils.s3_utils import s3_download_object_decorator
+from app.utils.utils import get_model_version
+from app.utils.executor_utils import model_loading_executor
+from app.ml_models_utils.model_export import export_tflite, export_metadata, model_quantization, passes_parity, runtime_batch_sizes, TFLiteModel
 import asyncio
+import threading
 
 import numpy as np
-from tensorflow.keras.models import load_model
-import threading
-from app.utils.custom_exceptions import ModelLoadingError
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Sequence
+from app.utils.custom_exceptions import ModelLoadingError, ModelNotFoundError
+from app.utils.metrics_utils import model_load_seconds
+from app.utils.cpu_utils import configure_tensorflow, runtime_threads
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStatus:
+    """Loading states reported by the readiness check."""
+
+    PENDING = "pending"
+    DOWNLOADING = "downloading"
+    # weights are on disk, the model loads on its next request
+    AVAILABLE = "available"
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+
+def _model_size_bytes(model) -> int:
+    """Memory taken by the weights of a model, used for the residency budget."""
+    if isinstance(model, TFLiteModel):
+        return model.size_bytes
+    size = 0
+    for weight in model.weights:
+        dtype = getattr(weight.dtype, "as_numpy_dtype", weight.dtype)
+        size += int(np.prod(weight.shape)) * np.dtype(dtype).itemsize
+    return size
+
+
+# process wide startup timings, reported by the readiness check
+startup_timings: Dict[str, float] = {}
+_tensorflow_import_lock = threading.Lock()
+
+
+def import_tensorflow() -> None:
+    """
+    Import TensorFlow on first use, recording how long it took.
+
+    It is never imported at module level: the gunicorn master, the
+    healthcheck and the image stages do not need it, and a worker
+    answers its healthcheck while TensorFlow loads in the model loading
+    pool.
+    """
+    with _tensorflow_import_lock:
+        if "tensorflow_import_s" in startup_timings:
+            return
+        started = time.perf_counter()
+        import tensorflow  # noqa: F401
+
+        configure_tensorflow()
+        startup_timings["tensorflow_import_s"] = round(time.perf_counter() - started, 3)
+    logger.info("Imported TensorFlow in %.2fs", startup_timings["tensorflow_import_s"])
+
+
+def load_keras_model(model_file_path: str):
+    from tensorflow.keras.models import load_model
+
+    return load_model(model_file_path)
+
+
+def warm_up_model(model, batch_sizes: Sequence[int] = (1,)) -> None:
+    """
+    Run synthetic batches through a model, so graph tracing and buffer
+    allocation happen before it takes traffic.
+
+    :param batch_sizes: sizes of the batches, one predict call each.
+    """
+    shape = tuple(model.input_shape[1:])
+    for batch_size in batch_sizes:
+        batch = np.zeros((batch_size,) + shape, dtype=np.float32)
+        model.predict(batch, batch_size=batch_size, verbose=0)
 
 
 class ModelManager:
+    """
+    Keeps track of the models resident in this worker.
+
+    Models are loaded on first use (single-flight, so concurrent requests
+    share one load) and kept in least recently used order. When the
+    resident weights exceed MODEL_MEMORY_BUDGET_MB, the least recently
+    used models that are not pinned are evicted; their weights stay on
+    disk and they load again on their next request.
+
+    Reloads are hot swaps: the new version is loaded and warmed up next
+    to the current one, then replaces it in a single assignment. Requests
+    already running finish on the version they started with.
+    """
+
     def __init__(self):
         self.model_directory = settings.WEIGHTS_DIR
-        self.loaded_models ={}
+        self.loaded_models: "OrderedDict[str, object]" = OrderedDict()
         self.class_dict = {}
-        self.model_locks = {}
+        # label arrays per model, see compile_class_labels
+        self.class_labels: Dict[str, np.ndarray] = {}
+        self.model_versions = {}
+        # bumped on every load, so a reload of unchanged S3 metadata
+        # still tells the new model apart from the one it replaced
+        self.model_generations: Dict[str, int] = {}
+        self._generation = 0
+        self.model_status = {}
+        self.load_timings = {}
+        self.model_sizes: Dict[str, int] = {}
+        self.last_used: Dict[str, float] = {}
+        self.pinned_models = {name.lower() for name in settings.PINNED_MODELS}
+        self.memory_budget = settings.MODEL_MEMORY_BUDGET_MB * 1024 * 1024
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._reload_locks: Dict[str, asyncio.Lock] = {}
+        # in-flight request count per model object, keyed by id()
+        self._in_flight: Dict[int, int] = {}
+        # replaced versions still serving requests, until they drain
+        self._retired: Dict[int, tuple] = {}
+
+    def model_file_path(self, model_name: str) -> str:
+        return os.path.join(self.model_directory, "models", f"{model_name.lower()}", f"{model_name.lower()}_model.h5")
 
-    @lru_cache(maxsize=10)
     def load_model(self, model_name: str):
         """
-        Load a model from weight file, and saves it to cache.
+        Load a model from its weight file.
+
+        This is blocking and is meant to run in the model loading pool,
+        registering the model is done by the caller on the event loop.
+        With SHARED_WEIGHTS the model is served from a TFLite export that
+        all workers map read-only, instead of a private Keras copy. With
+        OPTIMIZED_RUNTIME it is served from the TFLite export with the
+        XNNPACK delegate, when the export matches the Keras model. Both
+        use the quantized export set in MODEL_QUANTIZATION, if any.
+
+        :param model_name: name of the model.
+        :return: the loaded model.
         """
 
         # Define the path for the model file
-        model_file_path = os.path.join(self.model_directory,"models",f"{model_name.lower()}", f"{model_name.lower()}_model.h5")
+        model_file_path = self.model_file_path(model_name)
+        import_tensorflow()
 
         # Check if model file exists locally
         if os.path.exists(model_file_path):
-            #print(f"Loading model from local file: {model_file_path}")
-            lock = self.model_locks.setdefault(model_name, threading.Lock())
-            with lock:
-                try:
-                    model = load_model(model_file_path)
-                except Exception as e:
-                    raise e
-                if not model:
-                    raise ModelLoadingError(f"Model {model_name} failed to load")
-                self.loaded_models[model_name] = model
+            try:
+                if settings.SHARED_WEIGHTS:
+                    model = TFLiteModel(export_tflite(
+                        model_file_path, get_model_version(model_name), model_quantization(model_name),
+                    ), num_threads=runtime_threads(), batch_sizes=runtime_batch_sizes())
+                elif settings.OPTIMIZED_RUNTIME:
+                    model = self._load_optimized_model(model_name, model_file_path)
+                else:
+                    model = load_keras_model(model_file_path)
+            except Exception as e:
+                raise e
+            if not model:
+                raise ModelLoadingError(f"Model {model_name} failed to load")
+            return model
         else:
-            #print(f"File not found: {model_file_path}")
             raise FileNotFoundError(f"Model {model_name} not found at {model_file_path}")
 
+    def _load_optimized_model(self, model_name: str, model_file_path: str):
+        quantization = model_quantization(model_name)
+        try:
+            export_path = export_tflite(model_file_path, get_model_version(model_name), quantization)
+        except Exception as e:
+            logger.warning("Export of model %s failed, serving it with Keras: %s", model_name, e)
+            return load_keras_model(model_file_path)
+        if quantization:
+            # quantized outputs drift by design, the choice was measured
+            # with the quantization report instead of the parity check
+            logger.info(
+                "Serving %s export of model %s, parity %s",
+                quantization, model_name, export_metadata(export_path).get("parity"),
+            )
+        elif not passes_parity(export_path, settings.RUNTIME_PARITY_TOLERANCE):
+            logger.warning("Export of model %s does not match the Keras model, serving it with Keras", model_name)
+            return load_keras_model(model_file_path)
+        return TFLiteModel(
+            export_path, use_xnnpack=True, num_threads=runtime_threads(), batch_sizes=runtime_batch_sizes(),
+        )
 
-    
-    async def _load_model_from_s3(self, model_name: str):
+    def _load_and_warm_up(self, model_name: str):
         """
-        Download the model file from S3 and load it into memory.
+        Load a model and run the MODEL_WARMUP_BATCH_SIZES batches through
+        it, timing both. Blocking, run in the model loading pool.
+        """
+        # timed on its own, once per worker
+        import_tensorflow()
+        started = time.perf_counter()
+        model = self.load_model(model_name)
+        loaded = time.perf_counter()
+        batch_sizes = settings.MODEL_WARMUP_BATCH_SIZES
+        if batch_sizes and isinstance(model, TFLiteModel) and model.batch_sizes:
+            # allocates the interpreter of every padded batch size
+            batch_sizes = model.batch_sizes
+        warm_up_model(model, batch_sizes)
+        timings = self.load_timings.setdefault(model_name, {})
+        timings["load_s"] = round(loaded - started, 3)
+        timings["warmup_s"] = round(time.perf_counter() - loaded, 3)
+        model_load_seconds.observe(loaded - started, model=model_name, phase="load")
+        model_load_seconds.observe(time.perf_counter() - loaded, model=model_name, phase="warmup")
+        return model
+
+    def _register_model(self, model_name: str, model) -> None:
+        previous = self.loaded_models.get(model_name)
+        # the swap itself: new requests get the new version from here on
+        self.loaded_models[model_name] = model
+        if previous is not None and previous is not model:
+            self._retire(model_name, previous)
+        self.loaded_models.move_to_end(model_name)
+        self.last_used[model_name] = time.time()
+        self.model_sizes[model_name] = _model_size_bytes(model)
+        self.model_versions[model_name] = get_model_version(model_name)
+        self._generation += 1
+        self.model_generations[model_name] = self._generation
+        self._enforce_memory_budget(keep=model_name)
+
+    def resident_bytes(self) -> int:
+        return sum(self.model_sizes.get(name, 0) for name in self.loaded_models)
+
+    def _enforce_memory_budget(self, keep: str) -> None:
+        """
+        Evict least recently used models until the resident weights fit
+        in the budget. Pinned models and ``keep`` are never evicted.
+        """
+        if self.memory_budget <= 0:
+            return
+        for name in list(self.loaded_models.keys()):
+            if self.resident_bytes() <= self.memory_budget:
+                return
+            if name == keep or name in self.pinned_models:
+                continue
+            self.evict_model(name)
+        if self.resident_bytes() > self.memory_budget:
+            logger.warning(
+                "Resident models take %.1f MB, over the %.1f MB budget",
+                self.resident_bytes() / 2**20, self.memory_budget / 2**20,
+            )
+
+    def evict_model(self, model_name: str) -> None:
+        """
+        Drop a model from memory, its weights stay on disk.
+
+        Batches already running keep their own reference to the model.
+        """
+        if self.loaded_models.pop(model_name, None) is None:
+            return
+        self.model_status[model_name] = ModelStatus.AVAILABLE
+        logger.info("Evicted model %s (%.1f MB)", model_name, self.model_sizes.get(model_name, 0) / 2**20)
+
+    def _retire(self, model_name: str, model) -> None:
+        key = id(model)
+        version = self.model_versions.get(model_name)
+        if self._in_flight.get(key):
+            self._retired[key] = (model_name, version, model)
+            logger.info("Draining %d requests on model %s version %s", self._in_flight[key], model_name, version)
+        else:
+            logger.info("Retired model %s version %s", model_name, version)
+
+    def in_flight_requests(self) -> Dict[str, int]:
+        """In-flight requests per model, including versions being drained."""
+        counts: Dict[str, int] = {}
+        models = {id(model): name for name, model in self.loaded_models.items()}
+        models.update({key: entry[0] for key, entry in self._retired.items()})
+        for key, count in self._in_flight.items():
+            name = models.get(key)
+            if name is not None:
+                counts[name] = counts.get(name, 0) + count
+        return counts
+
+    @asynccontextmanager
+    async def use_model(self, model_name: str):
+        """
+        Hold a model for the duration of a request.
+
+        The request keeps the version it got even if a reload swaps in a
+        new one meanwhile; the old version is released once its last
+        request is done.
+
+        :param model_name: name of the model.
+        """
+        model = await self.get_model(model_name)
+        key = id(model)
+        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        try:
+            yield model
+        finally:
+            self._in_flight[key] -= 1
+            if not self._in_flight[key]:
+                del self._in_flight[key]
+                retired = self._retired.pop(key, None)
+                if retired is not None:
+                    logger.info("Drained model %s version %s", retired[0], retired[1])
+
+    async def get_model(self, model_name: str):
+        """
+        Return a resident model, loading it first if needed.
+
+        Concurrent callers for a model that is not resident wait on the
+        same load.
+
+        :param model_name: name of the model.
+        :return: the loaded model.
+        """
+        model = self.loaded_models.get(model_name)
+        if model is not None:
+            self.loaded_models.move_to_end(model_name)
+            self.last_used[model_name] = time.time()
+            return model
+        if model_name not in self.class_dict:
+            raise ModelNotFoundError(f"Model {model_name} is not found in classes.")
+
+        task = self._load_once(model_name, self._load_on_demand)
+        try:
+            # shielded, a cancelled request does not cancel the load for the others
+            return await asyncio.shield(task)
+        except (ModelNotFoundError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            raise ModelNotFoundError(f"Model {model_name} failed to load: {e}")
+
+    def _load_once(self, model_name: str, load, *args) -> asyncio.Future:
+        """
+        The in-flight load of a model, started as ``load(model_name, *args)``
+        when there is none, so concurrent loads of a model run once.
         """
-        print(f"Loading model from S3: {settings.AWS_WEIGHTS_BUCKET_NAME}/{model_name}")
+        task = self._loading.get(model_name)
+        if task is None:
+            task = asyncio.ensure_future(load(model_name, *args))
+            self._loading[model_name] = task
+            task.add_done_callback(lambda _: self._loading.pop(model_name, None))
+        return task
+
+    async def _load_on_demand(self, model_name: str):
+        if os.path.exists(self.model_file_path(model_name)):
+            await self._load_local_model(model_name)
+            return self.loaded_models[model_name]
+        return await self._download_and_load(model_name)
+
+    async def _download_and_load(self, model_name: str, download_limiter: Optional[asyncio.Semaphore] = None):
+        await self.download_model(model_name, download_limiter)
+        await self._load_local_model(model_name)
+        return self.loaded_models[model_name]
+
+    async def _load_local_model(self, model_name: str) -> None:
+        self._set_status(model_name, ModelStatus.LOADING)
+        started = time.perf_counter()
+        try:
+            model = await model_loading_executor.run(self._load_and_warm_up, model_name)
+        except BaseException:
+            self._set_status(model_name, ModelStatus.FAILED)
+            raise
+        self._register_model(model_name, model)
+        self._set_status(model_name, ModelStatus.READY)
+        timings = self.load_timings.setdefault(model_name, {})
+        logger.info(
+            "Model %s ready in %.2fs: load %.2fs, warm-up %.2fs",
+            model_name, time.perf_counter() - started, timings.get("load_s", 0), timings.get("warmup_s", 0),
+        )
+
+    def ready_models(self) -> list:
+        # available models are on disk and load on their first request
+        return [
+            name for name, status in self.model_status.items()
+            if status in (ModelStatus.READY, ModelStatus.AVAILABLE)
+        ]
+
+    def resident_models(self) -> list:
+        """
+        Describe the models currently in memory, least recently used first.
+        """
+        return [
+            {
+                "model_name": name,
+                "version": self.model_versions.get(name),
+                "size_mb": round(self.model_sizes.get(name, 0) / 2**20, 2),
+                "pinned": name in self.pinned_models,
+                "last_used": self.last_used.get(name),
+            }
+            for name in self.loaded_models
+        ]
+
+    def _set_status(self, model_name: str, status: str):
+        # a model that is being reloaded keeps serving its current version
+        if model_name in self.loaded_models and status != ModelStatus.READY:
+            return
+        self.model_status[model_name] = status
+
+    async def download_model(self, model_name: str, download_limiter: Optional[asyncio.Semaphore] = None):
+        """
+        Download the model file from S3, unless the local file is current.
+
+        :param model_name: name of the model.
+        :param download_limiter: optional semaphore bounding concurrent downloads.
+        """
+        model_name = model_name.lower()
+        logger.info("Downloading model from S3: %s/%s", settings.AWS_WEIGHTS_BUCKET_NAME, model_name)
+        self._set_status(model_name, ModelStatus.DOWNLOADING)
+        started = time.perf_counter()
 
         @s3_download_object_decorator(
         bucket_name=settings.AWS_WEIGHTS_BUCKET_NAME,
@@ -59,12 +417,64 @@ class ModelManager:
         async def _get_model(downloaded_file_path, object_key: str=""):
             return True if os.path.exists(downloaded_file_path) else False
 
+        try:
+            model_key = f"models/{model_name}/{model_name}_model.h5"
+            if download_limiter is not None:
+                async with download_limiter:
+                    result = await _get_model(object_key=model_key)
+            else:
+                result = await _get_model(object_key=model_key)
+            if not result:
+                raise Exception(f"Failed to retrive model {model_name}, from bucket {settings.AWS_WEIGHTS_BUCKET_NAME}.")
+        except BaseException:
+            self._set_status(model_name, ModelStatus.FAILED)
+            raise
 
-        model_key = f"models/{model_name.lower()}/{model_name.lower()}_model.h5"
-        result = await _get_model(object_key=model_key)
+        self._set_status(model_name, ModelStatus.AVAILABLE)
+        if model_name not in self.loaded_models:
+            self.model_versions[model_name] = get_model_version(model_name)
+        self.load_timings.setdefault(model_name, {})["download_s"] = round(time.perf_counter() - started, 3)
+        model_load_seconds.observe(time.perf_counter() - started, model=model_name, phase="download")
 
-        if result:
-            # Load the model from the downloaded file
-            self.load_model(model_name.lower())
-        else:
-            raise Exception(f"Failed to retrive model {model_name}, from bucket {settings.AWS_WEIGHTS_BUCKET_NAME}.")
\ No newline at end of file
+    async def _load_model_from_s3(self, model_name: str, download_limiter: Optional[asyncio.Semaphore] = None):
+        """
+        Download the model file from S3 and load it into memory.
+
+        The download is skipped when the local file is current, and the
+        blocking Keras load runs in the model loading pool. The load is
+        the one requests wait on, so a request for a model being preloaded
+        does not load it a second time. A model a request loaded first, from
+        a local file older than the one in S3, is reloaded.
+
+        :param model_name: name of the model.
+        :param download_limiter: optional semaphore bounding concurrent downloads.
+        """
+        model_name = model_name.lower()
+        task = self._loading.get(model_name)
+        if task is None and model_name not in self.loaded_models:
+            await asyncio.shield(self._load_once(model_name, self._download_and_load, download_limiter))
+            return
+        if task is not None:
+            await asyncio.shield(task)
+        await self.download_model(model_name, download_limiter)
+        if get_model_version(model_name) != self.model_versions.get(model_name):
+            await self.reload_model(model_name, download=False)
+
+    async def reload_model(self, model_name: str, download: bool = True):
+        """
+        Hot swap a model with the latest version of its weights.
+
+        The new version is loaded and warmed up in the model loading pool
+        while the current one keeps serving, then swapped in. Concurrent
+        reloads of the same model run one after the other.
+
+        :param model_name: name of the model.
+        :param download: fetch the weights from S3 first, False when
+            another worker already downloaded them.
+        """
+        model_name = model_name.lower()
+        lock = self._reload_locks.setdefault(model_name, asyncio.Lock())
+        async with lock:
+            if download:
+                await self.download_model(model_name)
+            await self._load_local_model(model_name)
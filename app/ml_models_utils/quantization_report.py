@@ -0,0 +1,157 @@
+"""
+Validation harness for the quantized exports.
+
+Runs a local sample set through the full precision Keras model and the
+TFLite exports of a model, and reports for each export its top-1
+agreement with the Keras model, the confidence drift of the Keras top-1
+class, the latency per image and the size. It builds the exports in the
+weights cache, where serving picks them up.
+
+    python -m app.ml_models_utils.quantization_report tomato ./samples --output report.json
+"""
+import os
+import json
+import time
+import argparse
+import logging
+from typing import List, Optional
+
+import numpy as np
+from app.ml_models_utils.model_export import export_tflite, TFLiteModel
+from app.utils.image_utils import preprocess_image_bytes, BatchBuffer
+from app.utils.utils import get_model_version
+from app.utils.cpu_utils import runtime_threads
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def load_samples(samples_dir: str, target_size=(299, 299)) -> np.ndarray:
+    """
+    Preprocess every image of a directory the way serving does.
+
+    :param samples_dir: directory of sample images.
+    :return: float32 batch of shape (N, H, W, 3).
+    """
+    paths = sorted(
+        os.path.join(samples_dir, name) for name in os.listdir(samples_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        raise ValueError(f"No images found in {samples_dir}")
+    images = []
+    for path in paths:
+        with open(path, "rb") as image_file:
+            images.append(preprocess_image_bytes(image_file.read(), target_size))
+    return BatchBuffer(len(images), target_size).fill(images).copy()
+
+
+def _predict(model, samples: np.ndarray, batch_size: int) -> np.ndarray:
+    outputs = [
+        np.asarray(model.predict(samples[start:start + batch_size], batch_size=batch_size, verbose=0))
+        for start in range(0, len(samples), batch_size)
+    ]
+    return np.concatenate(outputs)
+
+
+def _latency_ms(model, samples: np.ndarray, repeats: int) -> float:
+    """Median latency of single-image calls, as served without batching."""
+    image = samples[:1]
+    model.predict(image, batch_size=1, verbose=0)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(image, batch_size=1, verbose=0)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings) * 1000)
+
+
+def compare(reference: np.ndarray, outputs: np.ndarray) -> dict:
+    """
+    Compare the outputs of a model variant with the reference model.
+
+    :param reference: reference predictions, shape (N, classes).
+    :param outputs: predictions of the variant, same shape.
+    :return: top-1 agreement and confidence drift statistics.
+    """
+    top1 = np.argmax(reference, axis=-1)
+    rows = np.arange(len(reference))
+    drift = np.abs(outputs[rows, top1] - reference[rows, top1])
+    return {
+        "top1_agreement": float(np.mean(np.argmax(outputs, axis=-1) == top1)),
+        "mean_confidence_drift": float(np.mean(drift)),
+        "max_confidence_drift": float(np.max(drift)),
+        "max_abs_diff": float(np.max(np.abs(outputs - reference))),
+    }
+
+
+def build_report(
+    model_name: str,
+    samples_dir: str,
+    modes: List[Optional[str]],
+    batch_size: int = 16,
+    repeats: int = 20,
+) -> dict:
+    """
+    Measure the exports of a model against its Keras model.
+
+    :param model_name: name of the model, its weights must be downloaded.
+    :param samples_dir: directory of sample images.
+    :param modes: quantization modes to measure, None for full precision.
+    :param batch_size: batch size of the accuracy runs.
+    :param repeats: number of single-image calls timed per variant.
+    """
+    from tensorflow.keras.models import load_model
+    from app.utils.model_utils import model_manager
+
+    model_name = model_name.lower()
+    source_path = model_manager.model_file_path(model_name)
+    version = get_model_version(model_name)
+
+    samples = load_samples(samples_dir)
+    keras_model = load_model(source_path)
+    reference = _predict(keras_model, samples, batch_size)
+    report = {
+        "model": model_name,
+        "version": version,
+        "samples": len(samples),
+        "keras": {
+            "latency_ms": _latency_ms(keras_model, samples, repeats),
+            "size_mb": os.path.getsize(source_path) / 2**20,
+        },
+        "exports": {},
+    }
+    for mode in modes:
+        export_path = export_tflite(source_path, version, mode)
+        model = TFLiteModel(export_path, use_xnnpack=True, num_threads=runtime_threads())
+        result = compare(reference, _predict(model, samples, batch_size))
+        result["latency_ms"] = _latency_ms(model, samples, repeats)
+        result["size_mb"] = os.path.getsize(export_path) / 2**20
+        report["exports"][mode or "float32"] = result
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("model_name")
+    parser.add_argument("samples_dir", help="directory of sample images")
+    parser.add_argument("--modes", nargs="+", default=["float32", "float16", "int8"], choices=["float32", "float16", "int8"])
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=settings.log_level.value)
+    modes = [None if mode == "float32" else mode for mode in args.modes]
+    report = build_report(args.model_name, args.samples_dir, modes, args.batch_size, args.repeats)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
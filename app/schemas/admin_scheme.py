@@ -0,0 +1,6 @@
+from pydantic import BaseModel, Field
+
+
+class LoopMonitorRequest(BaseModel):
+    # 0 stops the monitor
+    threshold_ms: float = Field(..., ge=0)
@@ -1,11 +1,40 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from app.core.config import settings
 
 class InferenceRequest(BaseModel):
     model_name: str
     presigned_url: str
+    # also return the top_k most likely classes
+    top_k: Optional[int] = Field(None, ge=1)
+
+
+class ClassConfidence(BaseModel):
+    class_name: str
+    confidence: float
 
 
 class InferenceResponse(BaseModel):
     predicted_class: str
-    confidence: str
\ No newline at end of file
+    confidence: str
+    top_k: Optional[List[ClassConfidence]] = None
+
+
+class BatchInferenceRequest(BaseModel):
+    items: List[InferenceRequest] = Field(..., min_length=1, max_length=settings.BATCH_REQUEST_MAX_ITEMS)
+
+
+class BatchInferenceItem(BaseModel):
+    index: int
+    model_name: str
+    status_code: int
+    result: Optional[InferenceResponse] = None
+    error: Optional[str] = None
+
+
+class BatchInferenceResponse(BaseModel):
+    results: List[BatchInferenceItem]
+
+
+class StreamInferenceRequest(BaseModel):
+    items: List[InferenceRequest] = Field(..., min_length=1, max_length=settings.STREAM_REQUEST_MAX_ITEMS)
@@ -0,0 +1,158 @@
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+from app.utils.custom_exceptions import ServiceOverloadedError
+from app.utils.metrics_utils import metrics, stage_latency
+
+admission_rejections = metrics.counter(
+    "admission_rejections_total", "Requests shed by admission control, by reason.", ("model", "reason"),
+)
+
+# weight of the latest request in the service time average
+_SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionController:
+    """
+    Bounds the requests of a single model that are being processed.
+
+    At most ``max_concurrency`` requests hold a slot (fetch, preprocess
+    and forward pass) at once, the others wait in FIFO order, at most
+    ``max_queue`` of them. A request is rejected right away when the
+    queue is full or when its expected wait is longer than the deadline,
+    and a waiting request gives up once it waited for the deadline. The
+    expected wait comes from the average time requests hold a slot, so
+    under overload the excess is turned away in microseconds instead of
+    timing out with everything else.
+    """
+
+    def __init__(self, model_name: str, max_concurrency: int, max_queue: int, deadline_ms: float) -> None:
+        self.model_name = model_name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.deadline = max(0.0, deadline_ms) / 1000
+        self.active = 0
+        self.waiting = 0
+        # seconds a request holds a slot, averaged, None until one finished
+        self.service_time: Optional[float] = None
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def expected_wait(self, position: Optional[int] = None) -> float:
+        """
+        Seconds a new request would wait for a slot.
+
+        :param position: requests ahead of it in the queue, all of them by default.
+        """
+        if self.active < self.max_concurrency and not self.waiting:
+            return 0.0
+        if self.service_time is None:
+            return 0.0
+        position = self.waiting if position is None else position
+        return (position + 1) * self.service_time / self.max_concurrency
+
+    def _reject(self, reason: str, expected_wait: float) -> None:
+        admission_rejections.inc(model=self.model_name, reason=reason)
+        raise ServiceOverloadedError(
+            f"Model {self.model_name} is overloaded ({reason.replace('_', ' ')}), retry later.",
+            retry_after=max(1, math.ceil(expected_wait)),
+        )
+
+    def check(self) -> None:
+        """
+        Reject now if a new request would be rejected, without taking a slot.
+
+        :raises ServiceOverloadedError: with the suggested Retry-After.
+        """
+        if self.active < self.max_concurrency and not self.waiting:
+            return
+        expected_wait = self.expected_wait()
+        if self.waiting >= self.max_queue:
+            self._reject("queue_full", expected_wait)
+        if self.deadline and expected_wait > self.deadline:
+            self._reject("expected_wait", expected_wait)
+
+    async def _acquire(self) -> None:
+        self.check()
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.waiting += 1
+        try:
+            # the slot of a finished request is handed over, see _release
+            await asyncio.wait_for(future, self.deadline or None)
+        except asyncio.TimeoutError:
+            self._reject("deadline", self.expected_wait())
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # cancelled right after the slot was handed over
+                self._release()
+            raise
+        finally:
+            self.waiting -= 1
+
+    def _release(self) -> None:
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Hold a slot for the duration of a request.
+
+        :raises ServiceOverloadedError: when the request is shed.
+        """
+        waiting = time.perf_counter()
+        await self._acquire()
+        started = time.perf_counter()
+        stage_latency.observe(started - waiting, model=self.model_name, stage="admission_wait")
+        try:
+            yield
+        finally:
+            self._release()
+            elapsed = time.perf_counter() - started
+            if self.service_time is None:
+                self.service_time = elapsed
+            else:
+                self.service_time += _SERVICE_TIME_SMOOTHING * (elapsed - self.service_time)
+
+
+class AdmissionControl:
+    """
+    Keeps one ``AdmissionController`` per model, created on first use.
+
+    With ``max_concurrency`` set to 0, requests are admitted unchecked.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, deadline_ms: float) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.deadline_ms = deadline_ms
+        self.controllers: Dict[str, AdmissionController] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    def get_controller(self, model_name: str) -> AdmissionController:
+        controller = self.controllers.get(model_name)
+        if controller is None:
+            controller = AdmissionController(model_name, self.max_concurrency, self.max_queue, self.deadline_ms)
+            self.controllers[model_name] = controller
+        return controller
+
+    @asynccontextmanager
+    async def admit(self, model_name: str):
+        if not self.enabled:
+            yield
+            return
+        async with self.get_controller(model_name).admit():
+            yield
@@ -0,0 +1,135 @@
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+from app.utils.metrics_utils import stage_latency, batch_size
+
+
+BatchFunction = Callable[[str, List[Any]], Awaitable[Sequence[Any]]]
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests for a single model and runs them
+    as one batched forward pass.
+
+    A batch is closed when ``max_batch_size`` items are waiting or
+    ``max_wait_ms`` elapsed since its first item arrived, whichever
+    comes first. Results are fanned back out to each awaiting request.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        batch_fn: BatchFunction,
+        max_batch_size: int,
+        max_wait_ms: float,
+    ) -> None:
+        self.model_name = model_name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Queue a single item and wait for its result.
+
+        :param item: model input for one request.
+        :return: the output of the batch function for this item.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future, time.perf_counter()))
+        self._ensure_worker()
+        return await future
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def _collect(self) -> list:
+        """
+        Wait for the first item, then keep collecting until the batch
+        is full or the wait window is over.
+        """
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # requests cancelled while waiting (e.g. client went away) are dropped
+        return [entry for entry in batch if not entry[1].cancelled()]
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for _, _, enqueued in batch:
+                stage_latency.observe(started - enqueued, model=self.model_name, stage="queue_wait")
+            batch_size.observe(len(batch), model=self.model_name)
+            try:
+                outputs = await self.batch_fn(self.model_name, [item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+    async def close(self) -> None:
+        """Stop the worker task and fail any request still waiting."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        while not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.cancel()
+
+
+class BatchScheduler:
+    """
+    Keeps one ``MicroBatcher`` per model, created on first use.
+    """
+
+    def __init__(self, batch_fn: BatchFunction, max_batch_size: int, max_wait_ms: float) -> None:
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batchers: Dict[str, MicroBatcher] = {}
+
+    def get_batcher(self, model_name: str) -> MicroBatcher:
+        batcher = self.batchers.get(model_name)
+        if batcher is None:
+            batcher = MicroBatcher(model_name, self.batch_fn, self.max_batch_size, self.max_wait_ms)
+            self.batchers[model_name] = batcher
+        return batcher
+
+    async def submit(self, model_name: str, item: Any) -> Any:
+        return await self.get_batcher(model_name).submit(item)
+
+    async def shutdown(self) -> None:
+        for batcher in self.batchers.values():
+            await batcher.close()
+        self.batchers.clear()
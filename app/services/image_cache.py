@@ -0,0 +1,230 @@
+import os
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import numpy as np
+from app.utils.cache_utils import SizedLRUCache
+from app.utils.executor_utils import preprocess_executor
+from app.utils.metrics_utils import metrics
+from app.utils.s3_utils import S3ObjectId
+
+logger = logging.getLogger(__name__)
+
+image_cache_lookups = metrics.counter(
+    "image_cache_lookups_total",
+    "Preprocessed image lookups, by result: revalidated (304), disk (304 on a disk entry) or miss.", ("result",),
+)
+image_cache_evictions = metrics.counter(
+    "image_cache_evictions_total", "Images evicted from the preprocessed image cache in memory.",
+)
+
+ImageKey = Tuple[S3ObjectId, Tuple[int, int]]
+
+
+class CachedImage:
+    """
+    Preprocessed image of one version of an S3 object.
+
+    :param etag: ETag of the object the image was decoded from.
+    :param digest: content hash of the encoded image, for the prediction
+        cache, None when it was not computed.
+    :param image: preprocessed uint8 image, read-only.
+    """
+
+    __slots__ = ("etag", "digest", "image")
+
+    def __init__(self, etag: Optional[str], digest: Optional[str], image: np.ndarray) -> None:
+        image.flags.writeable = False
+        self.etag = etag
+        self.digest = digest
+        self.image = image
+
+    @property
+    def nbytes(self) -> int:
+        return self.image.nbytes
+
+
+class DiskImageCache:
+    """
+    Preprocessed images saved as .npz files, shared by the workers.
+
+    Files are written to a temporary name and renamed, so a reader never
+    sees a partial file. The modification time orders the files for
+    eviction and is bumped on reads. The size of the directory is counted
+    by each worker from a scan, so the bound is approximate when several
+    workers write at once.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max(0, max_bytes)
+        self._bytes: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.max_bytes > 0
+
+    def _path(self, key: ImageKey) -> str:
+        name = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name + ".npz")
+
+    def load(self, key: ImageKey) -> Optional[CachedImage]:
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                # guards against a hash collision
+                if str(saved["key"]) != repr(key):
+                    return None
+                cached = CachedImage(str(saved["etag"]) or None, str(saved["digest"]) or None, saved["image"])
+            os.utime(path)
+            return cached
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Dropping unreadable image cache file %s: %s", path, e)
+            self._remove(path)
+            return None
+
+    def save(self, key: ImageKey, cached: CachedImage) -> None:
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp_path, "wb") as cache_file:
+                np.savez(
+                    cache_file, key=repr(key), etag=cached.etag or "", digest=cached.digest or "",
+                    image=cached.image,
+                )
+            os.replace(temp_path, path)
+            if self._bytes is None:
+                self._bytes = self._scan()[1]
+            else:
+                self._bytes += os.path.getsize(path)
+            if self._bytes > self.max_bytes:
+                self._evict()
+        except OSError as e:
+            logger.warning("Failed to save image cache file %s: %s", path, e)
+            self._remove(temp_path)
+
+    def _scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files, sum(size for _, size, _ in files)
+
+    def _evict(self) -> None:
+        # down to 90% of the bound, so eviction does not run on every write
+        files, self._bytes = self._scan()
+        for _, size, path in sorted(files):
+            if self._bytes <= self.max_bytes * 0.9:
+                break
+            self._remove(path)
+            self._bytes -= size
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ImageCache:
+    """
+    Preprocessed images keyed on the S3 object they were fetched from.
+
+    Presigned URLs of the same object only differ in their signature, so
+    the key is the object (endpoint, bucket, key, version id) and the
+    model input size. The ETag is not part of the URL: it is learnt from
+    the response. Every request still sends its own URL to S3, as a
+    conditional GET on the cached ETag, so S3 checks its signature and
+    the object is current; a 304 costs a round trip but no download nor
+    decode.
+
+    A request finding the image being fetched for another one waits for
+    that download, then revalidates it with its own URL, so several
+    models run over one image download and decode it once. The download
+    runs in its own task, a request giving up does not cancel it for the
+    others.
+    """
+
+    def __init__(self, max_bytes: int, directory: str = "", disk_max_bytes: int = 0) -> None:
+        self.memory = SizedLRUCache(max_bytes)
+        self.disk = DiskImageCache(directory, disk_max_bytes)
+        self._loads: Dict[ImageKey, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.enabled
+
+    async def get(
+        self,
+        object_id: S3ObjectId,
+        target_size: Tuple[int, int],
+        load: Callable[[Optional[CachedImage]], Awaitable[Optional[CachedImage]]],
+    ) -> CachedImage:
+        """
+        Get the preprocessed image of an object, revalidated with the URL
+        of this request.
+
+        :param object_id: the S3 object of the image.
+        :param target_size: model input size of the image.
+        :param load: fetches the image with the URL of this request. Called
+            with the cached image to revalidate, or None; returns the new
+            image, or None when the cached one is still current.
+        """
+        key = (object_id, tuple(target_size))
+        loading = self._loads.get(key)
+        if loading is not None:
+            # its outcome is not used as is, only what it cached
+            await asyncio.wait([loading])
+
+        cached = self.memory.get(key)
+        result = "revalidated"
+        if cached is None and self.disk.enabled:
+            cached = await preprocess_executor.run(self.disk.load, key)
+            result = "disk"
+        if cached is not None:
+            loaded = await load(cached)
+            if loaded is None:
+                image_cache_lookups.inc(result=result)
+                self._store(key, cached)
+                return cached
+            image_cache_lookups.inc(result="miss")
+            await self._save(key, loaded)
+            return loaded
+
+        task = self._loads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._download(key, load))
+            self._loads[key] = task
+            task.add_done_callback(lambda done: self._loads.get(key) is done and self._loads.pop(key))
+            return await asyncio.shield(task)
+        # another request started the download meanwhile
+        await asyncio.wait([task])
+        return await self.get(object_id, target_size, load)
+
+    async def _download(self, key: ImageKey, load) -> CachedImage:
+        loaded = await load(None)
+        image_cache_lookups.inc(result="miss")
+        await self._save(key, loaded)
+        return loaded
+
+    async def _save(self, key: ImageKey, loaded: CachedImage) -> None:
+        # without an ETag, the image could never be revalidated
+        if loaded.etag is None:
+            return
+        self._store(key, loaded)
+        if self.disk.enabled:
+            await preprocess_executor.run(self.disk.save, key, loaded)
+
+    def _store(self, key: ImageKey, cached: CachedImage) -> None:
+        evicted = self.memory.set(key, cached, cached.nbytes)
+        if evicted:
+            image_cache_evictions.inc(evicted)
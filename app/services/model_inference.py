@@ -1,81 +1,433 @@
-from app.utils.s3_utils import download_image_from_s3
-from app.utils.image_utils import preprocess_image
+from app.utils.s3_utils import download_image_from_s3, download_image_if_modified, s3_object_id
+from app.utils.image_utils import load_image, preprocess_image, BatchBufferPool
+from app.utils.executor_utils import inference_executor, preprocess_executor
+from app.utils.cache_utils import LRUCache, image_digest
+from app.utils.metrics_utils import (
+    metrics, stage_latency, image_fetch_bytes, inference_requests, process_memory_bytes,
+)
 # from app.ml_models_utils.model_manager import ModelManager
-from app.schemas.inference_scheme import InferenceResponse
+from app.schemas.inference_scheme import InferenceRequest, InferenceResponse, BatchInferenceItem, ClassConfidence
 import numpy as np
-from app.utils.custom_exceptions import ModelNotFoundError, ImageProcessingError
-from app.utils.model_utils import model_manager, get_disease_name
+from app.utils.custom_exceptions import ModelNotFoundError, ImageProcessingError, ImageTooLargeError, ServiceOverloadedError
+from app.utils.model_utils import model_manager
 # Instantiate ModelManager
 # model_manager = ModelManager()
-import gc
+from app.services.batching import BatchScheduler
+from app.services.admission import AdmissionControl
+from app.services.postprocessing import Prediction, postprocess_batch
+from app.services.image_cache import CachedImage, ImageCache
+from app.core.config import settings
+import time
+import asyncio
+from contextlib import contextmanager
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional
 
-from typing import List
 
-async def run_inference_service(model_name: str, presigned_url: str) -> InferenceResponse:
-    # Load model from cache or S3
-    model = model_manager.loaded_models.get(model_name, None)
-    if not model:
-        raise ModelNotFoundError(f"Model {model_name} is not loaded.")
+# reusable model input buffers, shared by all models of this worker
+_batch_buffers = BatchBufferPool(settings.BATCH_MAX_SIZE)
 
-    # Download and preprocess the image from S3
+
+async def _predict_batch(model_name: str, images: List[np.ndarray]) -> List[Prediction]:
+    """
+    Run one forward pass over a batch of preprocessed images, and
+    postprocess the output of the whole batch at once.
+
+    :param model_name: name of the loaded model.
+    :param images: preprocessed uint8 images, each of shape (H, W, C).
+    :return: one prediction per image.
+    """
+    labels = model_manager.class_labels.get(model_name)
+    if labels is None:
+        raise ModelNotFoundError(f"Model {model_name} is not found in classes.")
+
+    def _predict(model, submitted: float):
+        started = time.perf_counter()
+        stage_latency.observe(started - submitted, model=model_name, stage="executor_wait")
+        with _batch_buffers.acquire() as buffer:
+            batch = buffer.fill(images)
+            predictions = model.predict(batch, batch_size=len(images), verbose=0)
+        predicted = time.perf_counter()
+        stage_latency.observe(predicted - started, model=model_name, stage="predict")
+        results = postprocess_batch(predictions, labels, settings.HEALTHY_CONFIDENCE_THRESHOLD)
+        stage_latency.observe(time.perf_counter() - predicted, model=model_name, stage="postprocess")
+        return results
+
+    # loads the model first if it is not resident, and keeps the version
+    # it got until the batch is done, even if a reload swaps it meanwhile.
+    # Batches of a model run one at a time, so no lock is needed
+    waiting = time.perf_counter()
+    async with model_manager.use_model(model_name) as model:
+        submitted = time.perf_counter()
+        stage_latency.observe(submitted - waiting, model=model_name, stage="model_wait")
+        # predict off the event loop so the next batch keeps filling meanwhile
+        return await inference_executor.run(_predict, model, submitted)
+
+
+batch_scheduler = BatchScheduler(
+    _predict_batch,
+    max_batch_size=settings.BATCH_MAX_SIZE,
+    max_wait_ms=settings.BATCH_MAX_WAIT_MS,
+)
+
+# bounds the requests of each model being processed, sheds the excess
+admission_control = AdmissionControl(
+    max_concurrency=settings.ADMISSION_MAX_CONCURRENCY,
+    max_queue=settings.ADMISSION_MAX_QUEUE,
+    deadline_ms=settings.ADMISSION_DEADLINE_MS,
+)
+
+# postprocessed predictions keyed on (model name, model load generation, image digest)
+prediction_cache = LRUCache(settings.PREDICTION_CACHE_SIZE, settings.PREDICTION_CACHE_TTL)
+prediction_cache_lookups = metrics.counter(
+    "prediction_cache_lookups_total", "Prediction cache lookups, by result: hit or miss.", ("result",),
+)
+prediction_cache_evictions = metrics.counter(
+    "prediction_cache_evictions_total", "Entries evicted from the prediction cache.",
+)
+
+
+# preprocessed images keyed on the S3 object of their presigned URL
+image_cache = ImageCache(
+    settings.IMAGE_CACHE_MAX_BYTES,
+    directory=settings.IMAGE_CACHE_DIR,
+    disk_max_bytes=settings.IMAGE_CACHE_DISK_MAX_BYTES,
+)
+
+
+def _prediction_cache_key(model_name: str, digest: str) -> tuple:
+    # the generation of the model a new batch would run on, a model
+    # loaded (again) after the lookup has a higher one
+    return model_name, model_manager.model_generations.get(model_name), digest
+
+
+def _cached_prediction(cache_key: tuple) -> Optional[Prediction]:
+    cached = prediction_cache.get(cache_key)
+    prediction_cache_lookups.inc(result="miss" if cached is None else "hit")
+    return cached
+
+
+def invalidate_model_predictions(model_name: str) -> int:
+    """
+    Drop the cached predictions of a model, e.g. after it was reloaded.
+
+    :param model_name: name of the model.
+    :return: number of dropped entries.
+    """
+    return prediction_cache.invalidate(lambda key: key[0] == model_name)
+
+
+# requests being served, per model
+_in_flight: Dict[str, int] = {}
+
+
+def _model_label(model_name: str) -> str:
+    # model names come from the clients, unknown ones share a label
+    return model_name if model_name in model_manager.class_dict else "unknown"
+
+
+@contextmanager
+def _track_request(model_name: str):
+    """Count and time one inference request, by response status."""
+    model_label = _model_label(model_name)
+    _in_flight[model_label] = _in_flight.get(model_label, 0) + 1
+    started = time.perf_counter()
+    status = 200
+    try:
+        yield
+    except Exception as e:
+        status = inference_error_status(e)
+        raise
+    finally:
+        _in_flight[model_label] -= 1
+        stage_latency.observe(time.perf_counter() - started, model=model_label, stage="total")
+        inference_requests.inc(model=model_label, status=status)
+
+
+metrics.gauge("inference_in_flight_requests", "Inference requests being served.", ("model",),
+              lambda: {(name,): count for name, count in _in_flight.items()})
+metrics.gauge("batch_queue_depth", "Images waiting for a forward pass.", ("model",),
+              lambda: {(name,): batcher.queue_depth for name, batcher in batch_scheduler.batchers.items()})
+metrics.gauge("admission_queue_depth", "Requests waiting for an admission slot.", ("model",),
+              lambda: {(name,): controller.waiting for name, controller in admission_control.controllers.items()})
+metrics.gauge("admission_active_requests", "Requests holding an admission slot.", ("model",),
+              lambda: {(name,): controller.active for name, controller in admission_control.controllers.items()})
+metrics.gauge("loaded_models", "Models resident in memory.", function=lambda: len(model_manager.loaded_models))
+metrics.gauge("resident_model_bytes", "Memory taken by the resident model weights.", function=model_manager.resident_bytes)
+metrics.gauge("model_in_use_requests", "Forward passes holding each model.", ("model",),
+              lambda: {(name,): count for name, count in model_manager.in_flight_requests().items()})
+metrics.gauge("process_resident_memory_bytes", "Resident memory of the worker.", function=process_memory_bytes)
+metrics.gauge("prediction_cache_entries", "Entries in the prediction cache.", function=lambda: len(prediction_cache))
+metrics.gauge("image_cache_bytes", "Memory taken by the preprocessed image cache.", function=lambda: image_cache.memory.bytes)
+metrics.gauge("image_cache_entries", "Entries in the preprocessed image cache.", function=lambda: len(image_cache.memory))
+
+
+def _check_model(model_name: str) -> None:
+    # Unknown models are rejected before downloading anything,
+    # the model itself is loaded on demand by the batcher
+    if model_name not in model_manager.class_dict:
+        raise ModelNotFoundError(f"Model {model_name} is not found in classes.")
+
+
+async def _fetch_and_preprocess(model_name: str, presigned_url: str, target_size=(299, 299)):
+    """
+    Download and preprocess one image, unless its prediction is cached.
+
+    Images of S3 objects go through the image cache, so the same object
+    is downloaded and decoded once for all the models run over it.
+
+    :return: (cache key, cached prediction or None, preprocessed image or None).
+    """
+    _check_model(model_name)
+
+    object_id = s3_object_id(presigned_url) if image_cache.enabled else None
+    if object_id is None:
+        image = await _fetch(model_name, download_image_from_s3, presigned_url)
+        image_fetch_bytes.observe(len(image), model=model_name)
+        return await _preprocess(model_name, image)
+
+    async def _load(cached: Optional[CachedImage]) -> Optional[CachedImage]:
+        return await _fetch_image(model_name, presigned_url, cached, target_size)
+
+    cached_image = await image_cache.get(object_id, target_size, _load)
+    cache_key = None
+    if prediction_cache.enabled and cached_image.digest is not None:
+        cache_key = _prediction_cache_key(model_name, cached_image.digest)
+        cached = _cached_prediction(cache_key)
+        if cached is not None:
+            return cache_key, cached, None
+    return cache_key, None, cached_image.image
+
+
+async def _fetch(model_name: str, download, *args):
+    """
+    Run one of the image downloads of s3_utils, timed as the fetch stage.
+
+    :param download: the download function, called with ``args``.
+    :return: what the download returned.
+    """
+    # Download the image from S3
+    started = time.perf_counter()
     try:
-        image = download_image_from_s3(presigned_url)
-        preprocessed_image = preprocess_image(image)
+        result = await download(*args)
+    except ImageProcessingError:
+        raise
     except Exception as e:
         raise ImageProcessingError(f"Image Processing error {str(e)}")
+    stage_latency.observe(time.perf_counter() - started, model=model_name, stage="fetch")
+    return result
 
-    lock = model_manager.model_locks.get(model_name)
-    if not lock:
-        raise ModelNotFoundError(f"Model {model_name} lock not found.")
-    with lock:
-        # Run inference
-        predictions = model.predict(preprocessed_image)
-    
-    print("predictions: ", predictions)
-
-    # Check if predictions is already a flat list of floats
-    if isinstance(predictions, np.ndarray):
-        # Convert to a flat list of floats
-        prediction_list = predictions.flatten().tolist()
-    elif isinstance(predictions, list):
-        # If predictions is a nested list, flatten it
-        prediction_list = [float(item) for sublist in predictions for item in sublist]
-    else:
-        raise ValueError("Predictions should be a numpy array or a list of floats")
-
-
-    if len(prediction_list) == 1:
-        predicted_class_index = 1 if prediction_list[0] >= 0.5 else 0
-        if predicted_class_index:
-            confidence = prediction_list[0]
-        else:
-            confidence = 1.0 - float(prediction_list[0])
-        is_healthy = False
-    else:
-        predicted_class_index = np.argmax(prediction_list)
-        confidence = prediction_list[predicted_class_index]
-        is_healthy = True if confidence < 0.6 else False
-        
-
-    
-    # print("predictions list: ", prediction_list)
-    # print("predictions index: ", predicted_class_index)
-    # print("confidence", confidence, type(confidence))
 
+async def _fetch_image(
+    model_name: str, presigned_url: str, cached: Optional[CachedImage], target_size,
+) -> Optional[CachedImage]:
+    """
+    Load an image for the image cache: download it, unless ``cached``
+    is still current, and preprocess it.
+
+    :return: the new image, or None if ``cached`` is still current.
+    """
+    etag = cached.etag if cached is not None else None
+    image, etag = await _fetch(model_name, download_image_if_modified, presigned_url, etag)
+    if image is None:
+        return None
+    image_fetch_bytes.observe(len(image), model=model_name)
+
+    digest = None
+    if prediction_cache.enabled:
+        started = time.perf_counter()
+        digest = await preprocess_executor.run(image_digest, image)
+        stage_latency.observe(time.perf_counter() - started, model=model_name, stage="hash")
+    try:
+        preprocessed_image = await preprocess_executor.run(_decode_and_preprocess, model_name, image, target_size)
+    except Exception as e:
+        raise ImageProcessingError(f"Image Processing error {str(e)}")
+    return CachedImage(etag, digest, preprocessed_image)
+
+
+def _decode_and_preprocess(model_name: str, image, target_size=(299, 299)) -> np.ndarray:
+    started = time.perf_counter()
+    decoded_image = load_image(image, target_size)
+    decoded_image.load()
+    decoded = time.perf_counter()
+    preprocessed_image = preprocess_image(decoded_image, target_size)
+    stage_latency.observe(decoded - started, model=model_name, stage="decode")
+    stage_latency.observe(time.perf_counter() - decoded, model=model_name, stage="preprocess")
+    return preprocessed_image
+
+
+async def _preprocess(model_name: str, image):
+    """
+    Preprocess one image, unless its prediction is cached.
+
+    :param image: encoded image bytes, or a binary file.
+    :return: (cache key, cached prediction or None, preprocessed image or None).
+    """
+    # Retries of the same image skip preprocessing and the forward pass
+    cache_key = None
+    if prediction_cache.enabled:
+        started = time.perf_counter()
+        digest = await preprocess_executor.run(image_digest, image)
+        stage_latency.observe(time.perf_counter() - started, model=model_name, stage="hash")
+        cache_key = _prediction_cache_key(model_name, digest)
+        cached = _cached_prediction(cache_key)
+        if cached is not None:
+            return cache_key, cached, None
 
     try:
-        if not is_healthy:
-            disease_name = get_disease_name(model_name, predicted_class_index)
-        else:
-            disease_name = "healthy"
+        preprocessed_image = await preprocess_executor.run(_decode_and_preprocess, model_name, image)
     except Exception as e:
-        raise e
+        raise ImageProcessingError(f"Image Processing error {str(e)}")
+    return cache_key, None, preprocessed_image
+
+
+def _respond(model_name: str, prediction: Prediction, top_k: Optional[int] = None, cache_key=None) -> InferenceResponse:
+    """
+    Build the response of one image from its postprocessed prediction.
+
+    :param top_k: also list the ``top_k`` most likely classes.
+    :param cache_key: cache the prediction under this key.
+    """
+    # a batch that ran on a model swapped out since the lookup must not
+    # cache its prediction after the swap invalidated the model's entries
+    if cache_key is not None and cache_key[1] == model_manager.model_generations.get(model_name):
+        evicted = prediction_cache.set(cache_key, prediction)
+        if evicted:
+            prediction_cache_evictions.inc(evicted)
+    result = InferenceResponse(predicted_class=prediction.label, confidence=str(prediction.confidence))
+    if top_k:
+        result.top_k = [
+            ClassConfidence(class_name=name, confidence=confidence)
+            for name, confidence in prediction.top_k(top_k, model_manager.class_labels[model_name])
+        ]
+    return result
+
+
+async def run_inference_service(model_name: str, presigned_url: str, top_k: Optional[int] = None) -> InferenceResponse:
+    with _track_request(model_name):
+        _check_model(model_name)
+        return await _infer(model_name, presigned_url, top_k)
+
+
+async def _infer(model_name: str, presigned_url: str, top_k: Optional[int] = None) -> InferenceResponse:
+    """Run one presigned URL image through a model, holding an admission slot."""
+    # the decoded image is only held once the request is admitted
+    async with admission_control.admit(model_name):
+        cache_key, cached, preprocessed_image = await _fetch_and_preprocess(model_name, presigned_url)
+        if cached is not None:
+            return _respond(model_name, cached, top_k)
+
+        # Run inference, batched with concurrent requests for the same model
+        prediction = await batch_scheduler.submit(model_name, preprocessed_image)
+        return _respond(model_name, prediction, top_k, cache_key)
+
 
-    # print("class: ", disease_name, type(disease_name) )
+async def run_upload_inference_service(
+    model_name: str, image_file: BinaryIO, top_k: Optional[int] = None,
+) -> InferenceResponse:
+    """
+    Run inference on an uploaded image file.
 
-    #Free Memory (SAFETY!)
-    del image
-    del preprocessed_image
-    gc.collect()
-    # Return an InferenceResponse object
-    return InferenceResponse(predicted_class=disease_name, confidence=str(confidence))
+    The file is hashed and decoded in place, straight from the spooled
+    upload, and goes through the same pipeline as presigned URL images,
+    so both paths give identical results.
+
+    :param model_name: name of the model.
+    :param image_file: binary file positioned at the start of the image.
+    :param top_k: also list the ``top_k`` most likely classes.
+    """
+    with _track_request(model_name):
+        _check_model(model_name)
+        async with admission_control.admit(model_name):
+            cache_key, cached, preprocessed_image = await _preprocess(model_name, image_file)
+            if cached is not None:
+                return _respond(model_name, cached, top_k)
+
+            prediction = await batch_scheduler.submit(model_name, preprocessed_image)
+            return _respond(model_name, prediction, top_k, cache_key)
+
+
+def inference_error_status(error: Exception) -> int:
+    """HTTP status code reported for an inference error."""
+    if isinstance(error, (ModelNotFoundError, ServiceOverloadedError)):
+        return 503
+    if isinstance(error, ImageTooLargeError):
+        return 413
+    if isinstance(error, ImageProcessingError):
+        return 422
+    return 500
+
+
+async def run_batch_inference_service(items: List[InferenceRequest]) -> List[BatchInferenceItem]:
+    """
+    Run inference over many images, reporting errors per item.
+
+    At most BATCH_FETCH_CONCURRENCY items are processed at a time. Each
+    one takes an admission slot of its model like a single request does,
+    so a large job is counted by admission control and sheds load the
+    same way, instead of flooding the batchers. Items in flight share
+    batches through the batchers.
+
+    :param items: the (model_name, presigned_url) items.
+    :return: one result or error per item, in the order of the items.
+    """
+    semaphore = asyncio.Semaphore(max(1, settings.BATCH_FETCH_CONCURRENCY))
+
+    async def _run_item(item: InferenceRequest) -> InferenceResponse:
+        model_name = item.model_name.lower()
+        _check_model(model_name)
+        async with semaphore:
+            return await _infer(model_name, item.presigned_url, item.top_k)
+
+    outcomes = await asyncio.gather(*[_run_item(item) for item in items], return_exceptions=True)
+
+    results = [_batch_item(index, item, outcome) for index, (item, outcome) in enumerate(zip(items, outcomes))]
+    for result in results:
+        inference_requests.inc(model=_model_label(result.model_name.lower()), status=result.status_code)
+    return results
+
+
+def _batch_item(index: int, item: InferenceRequest, outcome) -> BatchInferenceItem:
+    if isinstance(outcome, BaseException):
+        return BatchInferenceItem(
+            index=index, model_name=item.model_name,
+            status_code=inference_error_status(outcome), error=str(outcome),
+        )
+    return BatchInferenceItem(index=index, model_name=item.model_name, status_code=200, result=outcome)
+
+
+async def stream_inference_service(items: List[InferenceRequest]) -> AsyncIterator[BatchInferenceItem]:
+    """
+    Run inference over many images, yielding each result as it finishes.
+
+    At most STREAM_MAX_IN_FLIGHT images are downloaded or processed at a
+    time, so memory stays flat whatever the size of the job. Requests in
+    flight still share batches through the batchers. Closing the generator
+    (e.g. when the client disconnects) cancels the remaining work.
+
+    :param items: the (model_name, presigned_url) items.
+    :return: async iterator of per-item results, in completion order.
+    """
+    async def _run_item(index: int, item: InferenceRequest) -> BatchInferenceItem:
+        try:
+            outcome = await run_inference_service(item.model_name.lower(), item.presigned_url, item.top_k)
+        except Exception as e:
+            outcome = e
+        return _batch_item(index, item, outcome)
+
+    limit = max(1, settings.STREAM_MAX_IN_FLIGHT)
+    pending_items = iter(enumerate(items))
+    in_flight = set()
+    try:
+        while True:
+            for index, item in pending_items:
+                in_flight.add(asyncio.create_task(_run_item(index, item)))
+                if len(in_flight) >= limit:
+                    break
+            if not in_flight:
+                return
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
@@ -0,0 +1,114 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Dict, Optional
+from app.core.config import settings
+from app.services.model_inference import invalidate_model_predictions
+from app.utils.model_utils import model_manager
+from app.utils.utils import get_model_version, file_lock
+
+logger = logging.getLogger(__name__)
+
+
+def _read_reload_events() -> Dict[str, int]:
+    try:
+        with open(settings.RELOAD_EVENTS_PATH, "r") as events_file:
+            return json.load(events_file).get("models", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def publish_reload(model_name: str) -> int:
+    """
+    Tell the other workers that a model was reloaded.
+
+    Bumps the reload generation of the model in a file shared by all
+    workers of the box, which their ``ModelSyncWatcher`` polls.
+
+    :param model_name: name of the model.
+    :return: the new reload generation.
+    """
+    with file_lock(settings.RELOAD_EVENTS_PATH + ".lock"):
+        events = _read_reload_events()
+        events[model_name] = events.get(model_name, 0) + 1
+        temp_path = f"{settings.RELOAD_EVENTS_PATH}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as events_file:
+            json.dump({"models": events}, events_file)
+        os.replace(temp_path, settings.RELOAD_EVENTS_PATH)
+    model_sync_watcher.seen[model_name] = events[model_name]
+    return events[model_name]
+
+
+class ModelSyncWatcher:
+    """
+    Applies reloads published by other workers to this worker.
+
+    The worker that served /api/models/reload has already downloaded the
+    new weights, so the others hot swap from the local file.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.seen: Dict[str, int] = {}
+        self._mtime: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _events_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(settings.RELOAD_EVENTS_PATH).st_mtime_ns
+        except OSError:
+            return None
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._task is not None:
+            return
+        # reloads published before this worker started are already on disk
+        self._mtime = self._events_mtime()
+        self.seen = _read_reload_events()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error("Model sync failed: %s", e)
+
+    async def check(self) -> None:
+        mtime = self._events_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+        # a model is only marked as seen once its reload is applied, and a
+        # failed one keeps the file marked as changed, so it is retried
+        applied = True
+        for model_name, generation in _read_reload_events().items():
+            if generation <= self.seen.get(model_name, 0):
+                continue
+            logger.info("Model %s was reloaded by another worker", model_name)
+            try:
+                if model_name in model_manager.loaded_models:
+                    await model_manager.reload_model(model_name, download=False)
+                else:
+                    # not resident, it reads the new weights on its next load
+                    model_manager.model_versions[model_name] = get_model_version(model_name)
+            except Exception as e:
+                applied = False
+                logger.error("Failed to apply the reload of model %s, retrying: %s", model_name, e)
+                continue
+            self.seen[model_name] = generation
+            invalidate_model_predictions(model_name)
+        if applied:
+            self._mtime = mtime
+
+model_sync_watcher = ModelSyncWatcher(settings.MODEL_SYNC_INTERVAL)
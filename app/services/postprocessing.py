@@ -0,0 +1,85 @@
+import numpy as np
+from typing import Dict, List, Tuple
+
+HEALTHY_LABEL = "healthy"
+
+
+def compile_class_labels(class_dict: Dict[str, Dict[str, str]]) -> Dict[str, np.ndarray]:
+    """
+    Build the label array of each model, once when classes.json loads.
+
+    The labels are indexed by class index. Indices missing from
+    classes.json map to "", and so does any index past the end, through
+    a trailing "" entry that out of range indices are clipped to.
+
+    :param class_dict: class names by class index (as a string), per model.
+    :return: object array of labels per model.
+    """
+    labels = {}
+    for model_name, classes in class_dict.items():
+        names = {int(index): name for index, name in classes.items() if str(index).isdigit()}
+        array = np.full(max(names, default=-1) + 2, "", dtype=object)
+        for index, name in names.items():
+            array[index] = name
+        labels[model_name] = array
+    return labels
+
+
+def lookup_labels(labels: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    return labels[np.minimum(indices, len(labels) - 1)]
+
+
+class Prediction:
+    """
+    Postprocessed model output for one image.
+
+    :param label: predicted class name, or "healthy".
+    :param confidence: confidence of the predicted class.
+    :param scores: probability of each class.
+    :param ranking: class indices by decreasing probability.
+    """
+
+    __slots__ = ("label", "confidence", "scores", "ranking")
+
+    def __init__(self, label: str, confidence: float, scores: np.ndarray, ranking: np.ndarray) -> None:
+        self.label = label
+        self.confidence = confidence
+        self.scores = scores
+        self.ranking = ranking
+
+    def top_k(self, k: int, labels: np.ndarray) -> List[Tuple[str, float]]:
+        """The ``k`` most likely classes and their probabilities."""
+        indices = self.ranking[:k]
+        return list(zip(lookup_labels(labels, indices).tolist(), self.scores[indices].tolist()))
+
+
+def postprocess_batch(predictions, labels: np.ndarray, healthy_threshold: float = 0.6) -> List[Prediction]:
+    """
+    Turn the model output of a whole batch into predictions.
+
+    A single output is a sigmoid, the probability of class 1. Otherwise
+    the outputs are softmax probabilities, and a top class below
+    ``healthy_threshold`` means none of the diseases: "healthy".
+
+    :param predictions: model output of shape (N, classes).
+    :param labels: label array of the model, see ``compile_class_labels``.
+    :param healthy_threshold: confidence under which a softmax prediction is healthy.
+    :return: one prediction per image.
+    """
+    scores = np.asarray(predictions, dtype=np.float64).reshape(len(predictions), -1)
+    rows = np.arange(len(scores))
+    if scores.shape[1] == 1:
+        positive = scores[:, 0]
+        indices = (positive >= 0.5).astype(np.intp)
+        scores = np.stack([1.0 - positive, positive], axis=1)
+        names = lookup_labels(labels, indices)
+    else:
+        indices = np.argmax(scores, axis=1)
+        healthy = scores[rows, indices] < healthy_threshold
+        names = np.where(healthy, HEALTHY_LABEL, lookup_labels(labels, indices))
+    confidences = scores[rows, indices]
+    ranking = np.argsort(-scores, axis=1, kind="stable")
+    return [
+        Prediction(name, confidence, row_scores, row_ranking)
+        for name, confidence, row_scores, row_ranking in zip(names.tolist(), confidences.tolist(), scores, ranking)
+    ]
@@ -0,0 +1,171 @@
+import os
+import logging
+from typing import List, Optional
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores() -> List[int]:
+    """Cores this process may run on, e.g. limited by a container cpuset."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+class WorkerLayout:
+    """
+    Share of the CPU given to one worker: its cores and thread counts.
+
+    :param slot: index of the worker, 0 to workers - 1.
+    :param workers: number of workers on the box.
+    :param cores: cores of the worker.
+    :param total_cores: cores of the box.
+    :param pinned: whether the worker only runs on ``cores``.
+    :param intra_op_threads: threads of a TensorFlow op (and oneDNN/OpenMP).
+    :param inter_op_threads: TensorFlow ops run at the same time.
+    :param runtime_threads: threads of each TFLite interpreter.
+    :param inference_threads: forward passes run at the same time, each
+        with its own interpreter.
+    """
+
+    def __init__(self, slot: int, workers: int, cores: List[int], total_cores: int, pinned: bool,
+                 intra_op_threads: int, inter_op_threads: int, runtime_threads: int,
+                 inference_threads: int = 1) -> None:
+        self.slot = slot
+        self.workers = workers
+        self.cores = cores
+        self.total_cores = total_cores
+        self.pinned = pinned
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.runtime_threads = runtime_threads
+        self.inference_threads = inference_threads
+
+    @property
+    def oversubscribed(self) -> bool:
+        return self.workers * len(self.cores) > self.total_cores
+
+    @property
+    def runtime_oversubscribed(self) -> bool:
+        # concurrent forward passes of the worker each run runtime_threads,
+        # a single thread each is the least they can take
+        return self.runtime_threads > 1 and self.inference_threads * self.runtime_threads > len(self.cores)
+
+    def as_dict(self) -> dict:
+        return {
+            "slot": self.slot,
+            "workers": self.workers,
+            "cores": self.cores,
+            "total_cores": self.total_cores,
+            "pinned": self.pinned,
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+            "runtime_threads": self.runtime_threads,
+            "inference_threads": self.inference_threads,
+        }
+
+
+def plan_layout(slot: int, workers: int, cores: Optional[List[int]] = None) -> WorkerLayout:
+    """
+    Split the cores of the box across the workers.
+
+    Each worker gets CPU_CORES_PER_WORKER cores, or an even share of the
+    cores by default, taken in order from its slot, and its threads are
+    sized to that share unless set explicitly. The share is split between
+    the INFERENCE_THREADS forward passes a worker runs at once, since each
+    one runs its own TFLite interpreter threads.
+
+    :param slot: index of the worker.
+    :param workers: number of workers on the box.
+    :param cores: cores of the box, those of this process by default.
+    """
+    cores = cores or available_cores()
+    workers = max(1, workers)
+    per_worker = min(len(cores), settings.CPU_CORES_PER_WORKER or max(1, len(cores) // workers))
+    inference_threads = max(1, settings.INFERENCE_THREADS)
+    start = slot * per_worker
+    worker_cores = [cores[(start + index) % len(cores)] for index in range(per_worker)]
+    return WorkerLayout(
+        slot=slot,
+        workers=workers,
+        cores=worker_cores,
+        total_cores=len(cores),
+        pinned=settings.CPU_PIN_WORKERS,
+        intra_op_threads=settings.TF_INTRA_OP_THREADS or per_worker,
+        inter_op_threads=settings.TF_INTER_OP_THREADS or 1,
+        runtime_threads=settings.RUNTIME_NUM_THREADS or max(1, per_worker // inference_threads),
+        inference_threads=inference_threads,
+    )
+
+
+# layout of this process, set by configure_worker
+worker_layout: Optional[WorkerLayout] = None
+
+
+def configure_worker(slot: int = 0, workers: Optional[int] = None) -> WorkerLayout:
+    """
+    Apply the layout of this worker.
+
+    Must run before TensorFlow is imported: its thread pools, and the
+    OpenMP pool of oneDNN, are sized from the environment when they
+    start. Gunicorn workers are configured right after the fork, see
+    ``app.core.gunicorn_runner``.
+
+    :param slot: index of the worker.
+    :param workers: number of workers, workers_count by default.
+    """
+    global worker_layout
+    layout = plan_layout(slot, workers or settings.workers_count)
+    if layout.pinned and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, layout.cores)
+    os.environ["OMP_NUM_THREADS"] = str(layout.intra_op_threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(layout.intra_op_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = str(layout.inter_op_threads)
+    worker_layout = layout
+    return layout
+
+
+def configure_tensorflow() -> None:
+    """Size the thread pools of TensorFlow, right after its import."""
+    if worker_layout is None:
+        return
+    import tensorflow as tf
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(worker_layout.intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(worker_layout.inter_op_threads)
+    except RuntimeError as e:
+        # the pools already started, the environment variables applied
+        logger.debug("TensorFlow threads already set: %s", e)
+
+
+def runtime_threads() -> Optional[int]:
+    """Threads of the TFLite interpreter, None lets TFLite choose."""
+    if worker_layout is not None:
+        return worker_layout.runtime_threads
+    return settings.RUNTIME_NUM_THREADS or None
+
+
+def log_layout() -> None:
+    layout = worker_layout
+    if layout is None:
+        return
+    logger.info(
+        "Worker %d/%d on cores %s (%s) of %d: %d intra-op, %d inter-op threads, "
+        "%d inference threads x %d TFLite threads",
+        layout.slot + 1, layout.workers, layout.cores, "pinned" if layout.pinned else "not pinned",
+        layout.total_cores, layout.intra_op_threads, layout.inter_op_threads, layout.inference_threads,
+        layout.runtime_threads,
+    )
+    if layout.oversubscribed:
+        logger.warning(
+            "%d workers x %d cores is more than the %d cores of the box",
+            layout.workers, len(layout.cores), layout.total_cores,
+        )
+    if layout.runtime_oversubscribed:
+        logger.warning(
+            "%d inference threads x %d TFLite threads is more than the %d cores of the worker",
+            layout.inference_threads, layout.runtime_threads, len(layout.cores),
+        )
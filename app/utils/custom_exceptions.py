@@ -11,8 +11,27 @@ class ImageProcessingError(Exception):
         self.message = message
         super().__init__(self.message)
 
+class ImageTooLargeError(ImageProcessingError):
+    """Custom exception class raised when the image exceeds the size limit."""
+    def __init__(self, message="Image is too large"):
+        super().__init__(message)
+
 class ModelLoadingError(Exception):
     """Custom exception class raised when the model fails to load."""
     def __init__(self, message="model loading error"):
         self.message = message
         super().__init__(self.message)
+
+class ProfilerBusyError(Exception):
+    """Custom exception class raised when a profile is already running."""
+    def __init__(self, message="A profile is already running on this worker"):
+        self.message = message
+        super().__init__(self.message)
+
+class ServiceOverloadedError(Exception):
+    """Custom exception class raised when a request is shed under overload."""
+    def __init__(self, message="Service overloaded", retry_after: int = 1):
+        self.message = message
+        # seconds, sent as the Retry-After header
+        self.retry_after = retry_after
+        super().__init__(self.message)
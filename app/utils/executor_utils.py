@@ -0,0 +1,56 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from app.core.config import settings
+
+
+class StageExecutor:
+    """
+    Bounded thread pool for one stage of the inference pipeline.
+
+    Blocking work (image decoding, preprocessing, model.predict) is run
+    here so the event loop stays free for I/O and the healthcheck.
+    The pool is created lazily, so nothing is started in the gunicorn
+    master before the workers are forked.
+    """
+
+    def __init__(self, name: str, max_workers: int) -> None:
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix=f"{self.name}-stage",
+            )
+        return self._pool
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Run a blocking callable in the stage pool and await its result.
+
+        :param func: the callable to run.
+        :return: the callable's return value.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+
+preprocess_executor = StageExecutor("preprocess", settings.PREPROCESS_THREADS)
+inference_executor = StageExecutor("inference", settings.INFERENCE_THREADS)
+model_loading_executor = StageExecutor("model-loading", settings.MODEL_LOAD_THREADS)
+
+
+def shutdown_executors() -> None:
+    """Stop all stage pools, waiting for running work to finish."""
+    for executor in (preprocess_executor, inference_executor, model_loading_executor):
+        executor.shutdown()
@@ -0,0 +1,90 @@
+import aiohttp
+from yarl import URL
+from typing import Optional, Tuple
+from app.core.config import settings
+from app.utils.custom_exceptions import ImageTooLargeError
+
+
+class HTTPClient:
+    """
+    Shared, app-lifetime HTTP client for presigned URL fetches.
+
+    Keeps a pool of keep-alive connections per S3 host, so consecutive
+    downloads skip the TCP and TLS handshakes. It is opened on startup
+    and closed on shutdown (see app/core/lifetime.py).
+    """
+
+    def __init__(self) -> None:
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_POOL_SIZE,
+            limit_per_host=settings.HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=settings.HTTP_CONNECT_TIMEOUT,
+            sock_read=settings.HTTP_READ_TIMEOUT,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fetch_bytes(self, url: str, max_bytes: int) -> bytes:
+        """
+        Stream the body of a GET request, enforcing a size limit.
+
+        The download is aborted as soon as the body grows past
+        ``max_bytes``, instead of buffering it first.
+
+        :param url: the URL to fetch.
+        :param max_bytes: the maximum accepted body size.
+        :return: the response body.
+        """
+        body, _ = await self.fetch_if_modified(url, max_bytes)
+        return body
+
+    async def fetch_if_modified(self, url: str, max_bytes: int, etag: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Conditional GET: fetch the body unless it still has ``etag``.
+
+        :param url: the URL to fetch.
+        :param max_bytes: the maximum accepted body size.
+        :param etag: ETag of the copy held by the caller, if any.
+        :return: (body, ETag of the response), the body is None when the
+            server answered 304 Not Modified.
+        """
+        if self._session is None or self._session.closed:
+            await self.start()
+
+        headers = {"If-None-Match": etag} if etag else None
+        # presigned URLs are signed over the exact query string,
+        # so it must be sent as is, without re-quoting
+        async with self._session.get(URL(url, encoded=True), headers=headers) as response:
+            if response.status == 304:
+                return None, response.headers.get("ETag", etag)
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > max_bytes:
+                raise ImageTooLargeError(
+                    f"Image is {response.content_length} bytes, the limit is {max_bytes} bytes."
+                )
+            chunks = []
+            received = 0
+            async for chunk in response.content.iter_chunked(settings.HTTP_CHUNK_SIZE):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise ImageTooLargeError(f"Image is larger than the {max_bytes} bytes limit.")
+                chunks.append(chunk)
+            response_etag = response.headers.get("ETag")
+        body = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+        return body, response_etag
+
+http_client = HTTPClient()
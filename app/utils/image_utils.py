@@ -1,16 +1,125 @@
-from PIL import Image
+from io import BytesIO
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+import threading
 import numpy as np
+from app.core.config import settings
 
-def preprocess_image(image: Image.Image, target_size=(299, 299)) -> np.ndarray:
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+def load_image(data, target_size=None) -> "Image.Image":
+    """
+    Decode raw image bytes, or a binary file, into a PIL image.
+
+    When a target size is given and the image is a JPEG, the decoder is
+    put in draft mode so it decodes straight to the smallest 1/2, 1/4 or
+    1/8 scale that is still at least ``target_size``. Other formats are
+    decoded at full resolution.
+
+    :param data: encoded image bytes (JPEG, PNG, ...) or a binary file.
+    :param target_size: Tuple of the size the image will be resized to.
+    :return: PIL image object.
+    """
+    # imported on first use, with its codecs, see warm_up_image_pipeline
+    from PIL import Image
+
+    image = Image.open(data if hasattr(data, "read") else BytesIO(data))
+    if target_size and settings.JPEG_DRAFT_DECODE and image.format == "JPEG":
+        image.draft("RGB", target_size)
+    return image
+
+
+def preprocess_image(image: "Image.Image", target_size=(299, 299)) -> np.ndarray:
     """
     Preprocess the image for model inference.
 
+    Normalization is left to ``BatchBuffer.fill``, which writes the
+    float32 values straight into the model input.
+
     :param image: PIL image to preprocess.
     :param target_size: Tuple specifying target image size.
-    :return: Preprocessed image as numpy array.
+    :return: Preprocessed image as uint8 numpy array of shape (H, W, 3).
     """
     image = image.convert('RGB').resize(target_size)
-    image_array = np.array(image)
-    image_array = np.expand_dims(image_array, axis=0)
-    image_array = image_array / 255.0  # Normalize to [0, 1]
-    return image_array
+    return np.asarray(image)
+
+
+def preprocess_image_bytes(data, target_size=(299, 299)) -> np.ndarray:
+    """
+    Decode and preprocess raw image bytes in one step.
+
+    Meant to be run in the preprocess stage pool, off the event loop.
+
+    :param data: encoded image bytes, or a binary file read in place.
+    :param target_size: Tuple specifying target image size.
+    :return: Preprocessed image as uint8 numpy array of shape (H, W, 3).
+    """
+    return preprocess_image(load_image(data, target_size), target_size)
+
+
+def warm_up_image_pipeline(target_size=(299, 299)) -> None:
+    """
+    Decode and preprocess a synthetic JPEG, so importing PIL and loading
+    its codecs happen at startup rather than in the first request.
+
+    :param target_size: Tuple specifying target image size.
+    """
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", (target_size[0] * 2, target_size[1] * 2)).save(buffer, "JPEG")
+    preprocess_image_bytes(buffer.getvalue(), target_size)
+
+
+class BatchBuffer:
+    """
+    Preallocated float32 model input, reused for every batch.
+
+    Building a batch does not allocate: the uint8 pixels are normalized
+    to [0, 1] in place, without going through a float64 intermediate.
+    """
+
+    def __init__(self, max_batch_size: int, target_size=(299, 299), channels: int = 3):
+        width, height = target_size
+        self.array = np.empty((max_batch_size, height, width, channels), dtype=np.float32)
+
+    def fill(self, images) -> np.ndarray:
+        """
+        Write a list of preprocessed images into the buffer.
+
+        :param images: uint8 arrays of shape (H, W, 3).
+        :return: a view of the buffer holding the batch.
+        """
+        batch = self.array[:len(images)]
+        for index, image in enumerate(images):
+            np.divide(image, np.float32(255.0), out=batch[index], dtype=np.float32)
+        return batch
+
+
+class BatchBufferPool:
+    """
+    Per-worker pool of batch buffers, shared by all models.
+
+    It only grows to the number of batches running at the same time, so
+    memory does not grow with the number of models.
+    """
+
+    def __init__(self, max_batch_size: int, target_size=(299, 299)):
+        self.max_batch_size = max_batch_size
+        self.target_size = target_size
+        self._free = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            buffer = self._free.pop() if self._free else None
+        if buffer is None:
+            buffer = BatchBuffer(self.max_batch_size, self.target_size)
+        try:
+            yield buffer
+        finally:
+            with self._lock:
+                self._free.append(buffer)
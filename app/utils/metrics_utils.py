@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import glob
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a cache hit to a cold model load
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: dict) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+class Metric:
+    """Base of the metric types, values are kept per label values."""
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> dict:
+        """Values by label values, as saved in the worker snapshots."""
+        with self._lock:
+            return {json.dumps(key): value for key, value in self._values.items()}
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per bucket counts (the last one is +Inf), sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self) -> dict:
+        with self._lock:
+            return {json.dumps(key): [list(counts), total] for key, (counts, total) in self._values.items()}
+
+
+class Gauge(Metric):
+    """
+    Gauge read from a callback when the metrics are collected.
+
+    The callback returns the value, or a dict of values by label values
+    tuple for labelled gauges.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), function: Optional[Callable] = None) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def samples(self) -> dict:
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.debug("Gauge %s failed: %s", self.name, e)
+            return {}
+        if not isinstance(value, dict):
+            value = {(): value}
+        return {json.dumps([str(item) for item in key]): float(item_value) for key, item_value in value.items()}
+
+
+class MetricsRegistry:
+    """
+    Metrics of this worker, aggregated with the other gunicorn workers.
+
+    Each worker saves a snapshot of its metrics to METRICS_DIR every few
+    seconds, and the worker serving /api/metrics merges them: counters
+    and histograms are summed over all workers, including exited ones,
+    and gauges are reported per live worker with a ``pid`` label.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.metrics: Dict[str, Metric] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (), function: Optional[Callable] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def snapshot(self) -> dict:
+        return {"pid": os.getpid(), "time": time.time(), "metrics": {name: metric.samples() for name, metric in self.metrics.items()}}
+
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def write_snapshot(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._snapshot_path(os.getpid())
+        with open(path + ".tmp", "w") as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(path + ".tmp", path)
+
+    def _snapshots(self) -> List[dict]:
+        snapshots = [self.snapshot()]
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path, "r") as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+            if snapshot.get("pid") != os.getpid():
+                snapshot["alive"] = _pid_alive(snapshot.get("pid"))
+                snapshots.append(snapshot)
+        return snapshots
+
+    def collect(self) -> str:
+        """All workers' metrics, in the Prometheus text format."""
+        snapshots = self._snapshots()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            if isinstance(metric, Gauge):
+                for snapshot in snapshots:
+                    if snapshot.get("alive") is False:
+                        continue
+                    for key, value in snapshot["metrics"].get(name, {}).items():
+                        labels = dict(zip(metric.labelnames, json.loads(key)), pid=snapshot["pid"])
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+
+            merged: dict = {}
+            for snapshot in snapshots:
+                for key, value in snapshot["metrics"].get(name, {}).items():
+                    if isinstance(metric, Histogram):
+                        counts, total = merged.get(key, ([0] * (len(metric.buckets) + 1), 0.0))
+                        merged[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+            for key, value in sorted(merged.items()):
+                labels = dict(zip(metric.labelnames, json.loads(key)))
+                if isinstance(metric, Histogram):
+                    counts, total = value
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                        cumulative += count
+                        bucket_labels = dict(labels, le="+Inf" if bound == float("inf") else repr(bound))
+                        lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def start(self, interval: float) -> None:
+        if interval <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run(interval))
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                logger.error("Failed to save metrics snapshot: %s", e)
+            await asyncio.sleep(interval)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            # keeps the counters of this worker after it exits
+            self.write_snapshot()
+        except OSError:
+            pass
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    items = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + items + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def reset_metrics_dir(directory: str) -> None:
+    """Remove the snapshots of a previous run, before the workers start."""
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def process_memory_bytes() -> int:
+    """Resident set size of this process."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # peak, in KB on Linux, used where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+metrics = MetricsRegistry(settings.METRICS_DIR)
+
+stage_latency = metrics.histogram(
+    "inference_stage_seconds", "Time spent in each stage of inference requests.", ("model", "stage"),
+)
+image_fetch_bytes = metrics.histogram(
+    "image_fetch_bytes", "Size of the fetched images.", ("model",),
+    buckets=tuple(2 ** power for power in range(14, 26)),
+)
+batch_size = metrics.histogram(
+    "inference_batch_size", "Images per forward pass.", ("model",), buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+inference_requests = metrics.counter(
+    "inference_requests_total", "Inference requests by response status.", ("model", "status"),
+)
+model_load_seconds = metrics.histogram(
+    "model_load_seconds", "Time spent downloading, loading and warming up models.", ("model", "phase"),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
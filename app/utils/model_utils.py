@@ -1,12 +1,17 @@
 from app.core.config import settings
 import json
-from app.ml_models_utils.model_manager import ModelManager
+import time
+import logging
+from app.ml_models_utils.model_manager import ModelManager, ModelStatus, startup_timings
 import asyncio
-from app.utils.s3_utils import s3_download_object_decorator
-from app.utils.utils import update_model_version, initialize_model_version
-from app.utils.custom_exceptions import ModelNotFoundError
+from app.utils.s3_utils import s3_download_object_decorator, s3_manifest
+from app.utils.utils import initialize_model_version
+from app.services.postprocessing import compile_class_labels
+from app.utils.executor_utils import preprocess_executor
+from app.utils.image_utils import warm_up_image_pipeline
 
 model_manager = ModelManager()
+logger = logging.getLogger(__name__)
 
 
 #MODEL_CLASSES = {}
@@ -18,26 +23,72 @@ model_manager = ModelManager()
 async def get_classes(downloaded_file_path, object_key: str = ""):
 	try:
 		with open(downloaded_file_path, 'r') as file:
-			model_manager.class_dict = json.load(file)
+			class_dict = json.load(file)
+		# built once here, postprocessing only indexes them
+		model_manager.class_labels = compile_class_labels(class_dict)
+		model_manager.class_dict = class_dict
 	except Exception as e:
 		raise e
 
 
-async def preload_models():
+async def load_classes():
 	try:
 		initialize_model_version()
 		result = await get_classes(object_key="classes.json")
 	except Exception as e:
 		raise e
-
 	for i in model_manager.class_dict.keys():
-		result = await model_manager._load_model_from_s3(i)
+		model_manager.model_status.setdefault(i.lower(), ModelStatus.PENDING)
 
-	return True
 
-def get_disease_name(model_name:str, disease_index:int) -> str:
-	plant = model_manager.class_dict.get(model_name, None)
-	if plant:
-		disease_name = plant.get(str(disease_index), None)
-		return disease_name if disease_name else ""
-	raise ModelNotFoundError(f"Model {model_name} is not found in classes.")
\ No newline at end of file
+async def preload_models():
+	"""
+	Download and load every model in classes.json concurrently.
+
+	At most MODEL_DOWNLOAD_CONCURRENCY models are fetched at once, and the
+	Keras loads run in the model loading pool. A failing model is reported
+	and skipped, so the others can still serve traffic. With
+	MODEL_LAZY_LOADING only the pinned models are loaded, the others are
+	just downloaded and load on their first request. The weights are
+	checked against one listing of the bucket, instead of a HEAD request
+	per model. The image pipeline is warmed up meanwhile, and the
+	timings are reported by the readiness check.
+	"""
+	if not model_manager.class_dict:
+		await load_classes()
+	try:
+		listed = await s3_manifest.refresh(settings.AWS_WEIGHTS_BUCKET_NAME, "models/")
+		logger.info("Listed %d weight files in %s", listed, settings.AWS_WEIGHTS_BUCKET_NAME)
+	except Exception as e:
+		logger.warning("Listing %s failed, checking each model instead: %s", settings.AWS_WEIGHTS_BUCKET_NAME, e)
+
+	semaphore = asyncio.Semaphore(max(1, settings.MODEL_DOWNLOAD_CONCURRENCY))
+	started = time.perf_counter()
+
+	async def _preload(model_name: str):
+		model_name = model_name.lower()
+		try:
+			if settings.MODEL_LAZY_LOADING and model_name not in model_manager.pinned_models:
+				await model_manager.download_model(model_name, download_limiter=semaphore)
+			else:
+				await model_manager._load_model_from_s3(model_name, download_limiter=semaphore)
+		except Exception as e:
+			logger.error("Failed to preload model %s: %s", model_name, e)
+
+	async def _warm_up_images():
+		warm_up_started = time.perf_counter()
+		try:
+			await preprocess_executor.run(warm_up_image_pipeline)
+		except Exception as e:
+			logger.error("Failed to warm up the image pipeline: %s", e)
+		startup_timings["image_warmup_s"] = round(time.perf_counter() - warm_up_started, 3)
+
+	await asyncio.gather(_warm_up_images(), *[_preload(i) for i in model_manager.class_dict.keys()])
+	s3_manifest.clear()
+	startup_timings["preload_s"] = round(time.perf_counter() - started, 3)
+	logger.info(
+		"Preloaded %d/%d models in %.2fs, %d resident",
+		len(model_manager.ready_models()), len(model_manager.class_dict), time.perf_counter() - started,
+		len(model_manager.loaded_models),
+	)
+	return True
@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import sysconfig
+import traceback
+from collections import Counter
+from typing import Dict, Optional
+from app.core.config import settings
+from app.utils.metrics_utils import metrics
+from app.utils.custom_exceptions import ProfilerBusyError
+
+logger = logging.getLogger(__name__)
+
+loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "Delay of the event loop heartbeat.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+_STDLIB_DIR = sysconfig.get_paths()["stdlib"] + os.sep
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    # shorten installed packages and the standard library to their import path
+    for marker in ("site-packages" + os.sep, "dist-packages" + os.sep, _STDLIB_DIR):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+    return f"{code.co_name} ({filename}:{frame.f_lineno})".replace(";", ":")
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of every thread of the worker.
+
+    The stacks are read from ``sys._current_frames`` by a separate
+    thread, so nothing is instrumented and the overhead is a stack walk
+    per sample. Threads running native code (TensorFlow, PIL) show the
+    Python call that entered it. One profile runs at a time.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    def sample(self, seconds: float, interval: float) -> Dict[str, int]:
+        """
+        Take samples for ``seconds``, blocking.
+
+        :return: number of samples per collapsed stack, the thread name
+            being the root frame.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError()
+        try:
+            own_thread = threading.get_ident()
+            stacks: Counter = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame))
+                        frame = frame.f_back
+                    labels.append(names.get(thread_id, str(thread_id)))
+                    stacks[";".join(reversed(labels))] += 1
+                time.sleep(interval)
+            return dict(stacks)
+        finally:
+            self._lock.release()
+
+    async def profile(self, seconds: float, interval: float) -> str:
+        """
+        Profile the worker without blocking its event loop.
+
+        :param seconds: how long to sample.
+        :param interval: seconds between samples.
+        :return: the stacks in the collapsed format of flamegraph.pl and speedscope.
+        """
+        stacks = await asyncio.to_thread(self.sample, seconds, interval)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+class LoopLagMonitor:
+    """
+    Reports callbacks blocking the event loop.
+
+    A heartbeat task measures how late the loop wakes it up. A watchdog
+    thread checks the heartbeat and, when the loop has been stuck for
+    longer than the threshold, logs the stack of the loop thread, which
+    points at the blocking call while it is still running.
+    """
+
+    def __init__(self, threshold_ms: float) -> None:
+        self.threshold = threshold_ms / 1000
+        self.max_lag = 0.0
+        self.blocked_events = 0
+        self._heartbeat = 0.0
+        self._reported = 0.0
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.running,
+            "threshold_ms": self.threshold * 1000,
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+            "blocked_events": self.blocked_events,
+        }
+
+    def start(self, threshold_ms: Optional[float] = None) -> None:
+        if threshold_ms is not None:
+            self.threshold = threshold_ms / 1000
+        if self.threshold <= 0 or self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self._watchdog.join)
+        self._watchdog = None
+
+    async def _beat(self) -> None:
+        interval = max(0.01, self.threshold / 2)
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(0.0, now - expected)
+            loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.blocked_events += 1
+                logger.warning("Event loop was blocked for %.0f ms", lag * 1000)
+
+    def _watch(self) -> None:
+        interval = max(0.01, self.threshold / 2)
+        while not self._stopped.wait(interval / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - interval
+            if blocked <= self.threshold or heartbeat == self._reported:
+                continue
+            # once per blocking episode
+            self._reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame))
+                logger.warning("Event loop blocked for more than %.0f ms in:\n%s", blocked * 1000, stack)
+
+
+profiler = SamplingProfiler()
+loop_lag_monitor = LoopLagMonitor(settings.LOOP_LAG_THRESHOLD_MS)
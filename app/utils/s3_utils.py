@@ -1,32 +1,405 @@
-import requests
-from PIL import Image
-from io import BytesIO
+import re
 import aioboto3
+import hashlib
+import json
+import logging
 from functools import wraps
-from typing import Optional, Callable
+from typing import Dict, NamedTuple, Optional, Callable, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
 import asyncio
 from app.core.config import settings
 import os
 from pathlib import Path
-from app.utils.utils import get_model_version, update_model_version
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+from app.utils.utils import version_index, async_file_lock
+from app.utils.http_utils import http_client
+from app.utils.custom_exceptions import ModelLoadingError
 
-def download_image_from_s3(presigned_url: str) -> Image.Image:
+logger = logging.getLogger(__name__)
+
+async def download_image_from_s3(presigned_url: str) -> bytes:
     """
     Downloads an image from an AWS S3 presigned URL.
 
     :param presigned_url: The presigned URL for the S3 object.
-    :return: A PIL image object.
+    :return: the raw image bytes, decoding is left to the preprocess stage.
+    """
+    return await http_client.fetch_bytes(presigned_url, settings.IMAGE_MAX_BYTES)
+
+
+async def download_image_if_modified(presigned_url: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Downloads an image from an AWS S3 presigned URL, unless it still has ``etag``.
+
+    :param presigned_url: The presigned URL for the S3 object.
+    :param etag: ETag of the cached copy of the object, if any.
+    :return: (image bytes or None when the object did not change, its ETag).
+    """
+    return await http_client.fetch_if_modified(presigned_url, settings.IMAGE_MAX_BYTES, etag)
+
+
+class S3ObjectId(NamedTuple):
+    """S3 object a presigned URL points at, whatever its signature."""
+
+    endpoint: str
+    bucket: str
+    key: str
+    version_id: Optional[str]
+
+
+# [<bucket>.]<service>.amazonaws.com, the service being s3, s3.<region>,
+# s3-<region>, s3.dualstack.<region>, s3-accelerate...
+_AWS_S3_HOST = re.compile(r"^(?:(?P<bucket>.+)\.)?(?P<service>s3(?:[.-][a-z0-9-]+)*)\.amazonaws\.com(?:\.cn)?$")
+
+# query parameters of presigned URLs that leave the body of the object as is
+_SIGNATURE_PARAMS = {
+    "x-amz-algorithm", "x-amz-credential", "x-amz-date", "x-amz-expires", "x-amz-signedheaders",
+    "x-amz-signature", "x-amz-security-token", "awsaccesskeyid", "signature", "expires", "x-id",
+}
+
+
+def s3_object_id(presigned_url: str) -> Optional[S3ObjectId]:
+    """
+    Identify the object of a presigned URL, from its host and path.
+
+    Only URLs of S3 on AWS (virtual-hosted or path-style, not the website
+    and Object Lambda endpoints) and of the configured AWS_ENDPOINT_URL
+    are identified. The signature, expiry and credential query parameters
+    differ between two URLs of the same object and are ignored, as are
+    the ``response-*`` header overrides; ``versionId`` selects another
+    object. Any other query parameter (e.g. ``partNumber``) may change
+    the body, such URLs are not identified.
+
+    :return: the object, or None if the URL may not point at one.
+    """
+    try:
+        parts = urlsplit(presigned_url)
+        query = parse_qs(parts.query, keep_blank_values=True)
+    except ValueError:
+        return None
+    host = (parts.hostname or "").lower()
+    if not host or parts.scheme not in ("http", "https"):
+        return None
+    for name, values in query.items():
+        if name == "versionId" and len(values) == 1:
+            continue
+        if name.lower() in _SIGNATURE_PARAMS or name.lower().startswith("response-"):
+            continue
+        return None
+
+    path = unquote(parts.path).lstrip("/")
+    bucket = None
+    aws_host = _AWS_S3_HOST.match(host)
+    endpoint = urlsplit(settings.AWS_ENDPOINT_URL) if settings.AWS_ENDPOINT_URL else None
+    if aws_host:
+        service = aws_host.group("service")
+        if "website" in service or "object-lambda" in service:
+            return None
+        endpoint_name, bucket = "amazonaws.com", aws_host.group("bucket")
+    elif endpoint is not None and endpoint.hostname and parts.port == endpoint.port \
+            and (host == endpoint.hostname.lower() or host.endswith("." + endpoint.hostname.lower())):
+        endpoint_name = endpoint.netloc.lower()
+        if host != endpoint.hostname.lower():
+            bucket = host[:-len(endpoint.hostname) - 1]
+    else:
+        return None
+    if bucket is None:
+        bucket, _, key = path.partition("/")
+    else:
+        key = path
+    if not bucket or not key:
+        return None
+    return S3ObjectId(endpoint_name, bucket, key, query.get("versionId", [None])[0])
+
+
+class S3Client:
+    """
+    One S3 client shared by all the downloads of the worker.
+
+    Opening a client per object costs a session, a credentials lookup
+    and a new connection pool; the shared client keeps its connections
+    alive, enough of them for parallel part downloads. It is created on
+    first use and closed at shutdown.
+    """
+
+    def __init__(self) -> None:
+        self._context = None
+        self._client = None
+        self._lock = asyncio.Lock()
+
+    async def get(self):
+        if self._client is None:
+            async with self._lock:
+                if self._client is None:
+                    context = aioboto3.Session().client(
+                        "s3",
+                        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                        region_name=settings.AWS_DEFAULT_REGION,
+                        endpoint_url=settings.AWS_ENDPOINT_URL,
+                        config=AioConfig(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS),
+                    )
+                    self._client = await context.__aenter__()
+                    self._context = context
+        return self._client
+
+    async def close(self) -> None:
+        if self._context is not None:
+            context, self._context, self._client = self._context, None, None
+            await context.__aexit__(None, None, None)
+
+
+s3_client = S3Client()
+
+
+class S3Manifest:
+    """
+    Listing of the weights bucket, taken once at startup.
+
+    Checking every model with its own HEAD request costs a round trip
+    per model. A single listing gives the latest version, size and ETag
+    of all of them, and a listed object whose local copy matches the
+    version index is used without any request. Entries are used once:
+    later checks, such as reloads, make a fresh HEAD request.
+    """
+
+    def __init__(self) -> None:
+        self._objects: Dict[Tuple[str, str], dict] = {}
+
+    async def refresh(self, bucket_name: str, prefix: str) -> int:
+        """
+        List the objects under ``prefix``.
+
+        :return: number of listed objects.
+        """
+        client = await s3_client.get()
+        objects = {}
+        try:
+            paginator = client.get_paginator("list_object_versions")
+            async for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for version in page.get("Versions", []):
+                    if version.get("IsLatest"):
+                        objects[(bucket_name, version["Key"])] = version
+        except ClientError as e:
+            # without s3:ListBucketVersions, the ETag still identifies the content
+            logger.info("Listing versions of %s failed, listing objects instead: %s", bucket_name, e)
+            paginator = client.get_paginator("list_objects_v2")
+            async for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for listed in page.get("Contents", []):
+                    objects[(bucket_name, listed["Key"])] = listed
+        self._objects.update(objects)
+        return len(objects)
+
+    def take(self, bucket_name: str, key: str) -> Optional[dict]:
+        return self._objects.pop((bucket_name, key), None)
+
+    def clear(self) -> None:
+        self._objects.clear()
+
+
+s3_manifest = S3Manifest()
+
+
+def _file_md5s(path: Path, part_size: int):
+    with open(path, "rb") as file:
+        while True:
+            md5 = hashlib.md5()
+            remaining = part_size
+            while remaining:
+                chunk = file.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            if remaining == part_size:
+                return
+            yield md5
+
+
+def multipart_etag(path: Path, part_size: int) -> str:
+    """
+    ETag S3 gives a multipart upload of a file: the MD5 of the
+    concatenated MD5s of its parts, followed by the number of parts.
+
+    :param path: path of the file.
+    :param part_size: size of the parts of the upload.
+    """
+    digests = [md5.digest() for md5 in _file_md5s(path, part_size)]
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def verify_downloaded_file(path: Path, expected_size: Optional[int], etag: Optional[str], part_size: Optional[int] = None) -> None:
+    """
+    Check a downloaded object against the size and ETag reported by S3.
+
+    For single-part uploads the ETag is the MD5 of the object. For
+    multipart uploads it is rebuilt from the MD5s of the parts, when the
+    part size of the upload is known, otherwise only the size is checked.
+
+    :param path: path of the downloaded file.
+    :param expected_size: ContentLength of the S3 object.
+    :param etag: ETag of the S3 object.
+    :param part_size: part size of a multipart upload.
+    :raises ModelLoadingError: if the file does not match.
+    """
+    size = os.path.getsize(path)
+    if expected_size is not None and size != expected_size:
+        raise ModelLoadingError(f"{path} is {size} bytes, expected {expected_size} bytes.")
+
+    etag = (etag or "").strip('"')
+    if not settings.VERIFY_WEIGHTS_CHECKSUM or not etag:
+        return
+    if "-" in etag:
+        if not part_size:
+            return
+        checksum = multipart_etag(path, part_size)
+    else:
+        md5 = hashlib.md5()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                md5.update(chunk)
+        checksum = md5.hexdigest()
+    if checksum != etag:
+        raise ModelLoadingError(f"{path} checksum {checksum} does not match ETag {etag}.")
+
+
+async def _multipart_part_size(client, bucket_name: str, key: str, head: dict, etag: Optional[str]) -> Optional[int]:
+    """Part size of a multipart upload, from the size of its first part."""
+    if not etag or "-" not in etag or not settings.VERIFY_WEIGHTS_CHECKSUM:
+        return None
+    kwargs = {"Bucket": bucket_name, "Key": key, "PartNumber": 1}
+    if head.get("VersionId"):
+        kwargs["VersionId"] = head["VersionId"]
+    part = await client.head_object(**kwargs)
+    return part.get("ContentLength")
+
+
+def _read_download_state(state_path: str) -> dict:
+    try:
+        with open(state_path, "r") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_download_state(state_path: str, state: dict) -> None:
+    with open(state_path + ".tmp", "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+async def _download_parts(client, bucket_name: str, key: str, head: dict, part_path: str) -> None:
     """
-    response = requests.get(presigned_url)
-    response.raise_for_status()
-    image = Image.open(BytesIO(response.content))
-    return image
+    Download an object into ``part_path`` as concurrent ranged GETs.
+
+    The finished parts are recorded next to the file, so a download
+    interrupted by a crash or a network error resumes where it stopped,
+    as long as the object did not change meanwhile. Every range is
+    requested for the version (or ETag) seen by the HEAD request, so the
+    parts can not mix two versions of the object.
+    """
+    size = head["ContentLength"]
+    part_size = max(1, settings.S3_PART_SIZE)
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    state_path = part_path + ".json"
+    identity = {"etag": head.get("ETag"), "version_id": head.get("VersionId"), "size": size, "part_size": part_size}
+
+    state = _read_download_state(state_path)
+    if state.get("identity") != identity or not os.path.exists(part_path):
+        state = {"identity": identity, "done": []}
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(size)
+        _write_download_state(state_path, state)
+    done = set(state["done"])
+    if done:
+        logger.info("%s: resuming, %d/%d parts already downloaded", key, len(done), len(ranges))
+
+    semaphore = asyncio.Semaphore(max(1, settings.S3_PART_CONCURRENCY))
+    fd = os.open(part_path, os.O_WRONLY)
+
+    async def _download_part(index: int, start: int, end: int) -> None:
+        kwargs = {"Bucket": bucket_name, "Key": key, "Range": f"bytes={start}-{end}"}
+        if head.get("VersionId"):
+            kwargs["VersionId"] = head["VersionId"]
+        elif head.get("ETag"):
+            kwargs["IfMatch"] = head["ETag"]
+        async with semaphore:
+            response = await client.get_object(**kwargs)
+            offset = start
+            async for chunk in response["Body"].iter_chunks(1024 * 1024):
+                await asyncio.to_thread(os.pwrite, fd, chunk, offset)
+                offset += len(chunk)
+        if offset != end + 1:
+            raise ModelLoadingError(f"{key}: part {index} ended at byte {offset}, expected {end + 1}.")
+        done.add(index)
+        state["done"] = sorted(done)
+        _write_download_state(state_path, state)
+
+    try:
+        # every part finishes or fails before the file is closed
+        results = await asyncio.gather(
+            *[_download_part(index, start, end) for index, (start, end) in enumerate(ranges) if index not in done],
+            return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+        await asyncio.to_thread(os.fsync, fd)
+    finally:
+        os.close(fd)
+
+
+async def _is_current(saved_file_path: Path, model_name: str, version_id: str,
+                      expected_size: Optional[int], etag: Optional[str], part_size: Optional[int]) -> bool:
+    """
+    Check that the local file is the verified copy of the S3 object.
+    """
+    record = version_index.get(model_name)
+    if version_id != 'null' and version_id != record.get("version"):
+        return False
+    # a truncated file left by an interrupted download is fetched again
+    if expected_size is not None and os.path.getsize(saved_file_path) != expected_size:
+        return False
+    if not etag or not settings.VERIFY_WEIGHTS_CHECKSUM or record.get("etag") == etag:
+        return True
+    # downloaded before ETags were recorded, it is checked once
+    try:
+        await asyncio.to_thread(verify_downloaded_file, saved_file_path, expected_size, etag, part_size)
+    except ModelLoadingError as e:
+        logger.warning("%s", e)
+        return False
+    version_index.update(model_name, version=record.get("version", version_id), etag=etag, size=expected_size)
+    return True
+
+
+def _matches_listing(saved_file_path: Path, model_name: str, listed: dict) -> bool:
+    """
+    Check a local file against its entry in the bucket listing.
+
+    Only files whose ETag was recorded after a verified download match,
+    the listing has no checksum for the others (e.g. SSE-KMS objects).
+    """
+    record = version_index.get(model_name)
+    if not record.get("etag") or record["etag"] != listed.get("ETag"):
+        return False
+    version_id = listed.get("VersionId")
+    if version_id and version_id != 'null' and version_id != record.get("version"):
+        return False
+    return os.path.getsize(saved_file_path) == listed.get("Size")
 
 
 async def s3_download_object(bucket_name: str, key: str, file_path: str):
     """
     A helper function to downloads an S3 object.
 
+    The object is downloaded into a temp file, in parallel ranged parts,
+    verified against its size and ETag, then renamed over the current
+    file. A crash never leaves a truncated file in place, and workers
+    downloading the same object wait for the first one instead. Objects
+    listed by ``s3_manifest`` are checked against the listing, without
+    a HEAD request.
+
     :param bucket_name: The name of the S3 bucket.
     :param key: key name of the S3 object
     :file_path: path to write the downloaded object
@@ -37,33 +410,46 @@ async def s3_download_object(bucket_name: str, key: str, file_path: str):
     saved_file_dir= saved_file_path.parent
     model_name = saved_file_dir.name
 
-    #check if the file exist
-
     if not os.path.exists(saved_file_dir):
         os.makedirs(saved_file_dir, exist_ok=True)
 
-    async with aioboto3.Session().client(
-        "s3",
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        region_name=settings.AWS_DEFAULT_REGION
-    ) as s3_client:
-        try:
-            # get the S3 Object version
-            response = await s3_client.head_object(Bucket=bucket_name, Key=key)
-            file_version_id = response.get('VersionId', 'null')
-            if saved_file_path.is_file():
-                #check the current file version
-                current_file_version = get_model_version(model_name)
-                if (file_version_id == 'null') or (file_version_id == current_file_version) :
-                    print("identical version")
-                    return saved_file_path
-            print(f"downloading {model_name}")
-            await s3_client.download_file(bucket_name, key, saved_file_path)
-            update_model_version(model_name, file_version_id)
+    listed = s3_manifest.take(bucket_name, key)
+    if listed is not None:
+        async with async_file_lock(f"{saved_file_path}.lock"):
+            if saved_file_path.is_file() and _matches_listing(saved_file_path, model_name, listed):
+                logger.info("%s: identical version", key)
+                return saved_file_path
+
+    client = await s3_client.get()
+    # get the S3 Object version
+    head = await client.head_object(Bucket=bucket_name, Key=key)
+    file_version_id = head.get('VersionId', 'null')
+    expected_size = head.get('ContentLength')
+    # SSE-KMS objects have ETags that are not MD5 checksums
+    etag = None if head.get('ServerSideEncryption') == 'aws:kms' else head.get('ETag')
+    part_size = await _multipart_part_size(client, bucket_name, key, head, etag)
+
+    async with async_file_lock(f"{saved_file_path}.lock"):
+        if saved_file_path.is_file() and await _is_current(
+            saved_file_path, model_name, file_version_id, expected_size, etag, part_size,
+        ):
+            logger.info("%s: identical version", key)
             return saved_file_path
-        except Exception as e:
-            raise e
+
+        logger.info("%s: downloading", key)
+        part_path = f"{saved_file_path}.part"
+        await _download_parts(client, bucket_name, key, head, part_path)
+        try:
+            await asyncio.to_thread(verify_downloaded_file, part_path, expected_size, etag, part_size)
+        except ModelLoadingError:
+            os.remove(part_path)
+            raise
+        finally:
+            if os.path.exists(f"{part_path}.json"):
+                os.remove(f"{part_path}.json")
+        os.replace(part_path, saved_file_path)
+        version_index.record_download(model_name, file_version_id, etag, expected_size)
+        return saved_file_path
 
 def s3_download_object_decorator(bucket_name: str, file_path: str, modify_function: Optional[Callable] = None):
     """
@@ -1,44 +1,165 @@
 from app.core.config import settings
 import json
 import asyncio
+import fcntl
 import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, Optional
+from contextlib import contextmanager, asynccontextmanager
 
-def initialize_model_version()->bool:
-	if not os.path.exists(settings.WEIGHTS_DIR):
-		os.makedirs(settings.WEIGHTS_DIR, exist_ok=True)
+logger = logging.getLogger(__name__)
 
-	if not os.path.exists(settings.VERSIONS_PATH):
-		with open(settings.VERSIONS_PATH, 'w') as json_file:
-			json.dump({"models": {}}, json_file)
 
-def update_model_version(model_name: str, version: str):
-	# Check if the JSON file exists; if not, create an empty one
-	if not os.path.exists(settings.VERSIONS_PATH):
-		raise FileNotFoundError
+@contextmanager
+def file_lock(path: str):
+	"""
+	Exclusive lock across processes (e.g. gunicorn workers), held while the block runs.
 
-	# Load the existing data from the JSON file
-	with open(settings.VERSIONS_PATH, 'r') as json_file:
-		data = json.load(json_file)
+	:param path: path of the lock file.
+	"""
+	with open(path, "a") as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-	# Update or add the version for the given model_name
-	data["models"][model_name] = {"version": version}
 
-	# Save the updated data back to the JSON file
-	with open(settings.VERSIONS_PATH, 'w') as json_file:
-		json.dump(data, json_file, indent=4)
+@asynccontextmanager
+async def async_file_lock(path: str, poll_interval: float = 0.1):
+	"""
+	Same as ``file_lock``, but waits for the lock without blocking the event loop.
 
-	print(f"Updated {model_name} with version {version}")
-	
-def get_model_version(model_name: str) -> str | None:
-	if not os.path.exists(settings.VERSIONS_PATH):
-		raise FileNotFoundError
+	:param path: path of the lock file.
+	:param poll_interval: seconds between attempts to take the lock.
+	"""
+	with open(path, "a") as lock_file:
+		while True:
+			try:
+				fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				break
+			except BlockingIOError:
+				await asyncio.sleep(poll_interval)
+		try:
+			yield
+		finally:
+			fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ModelVersionIndex:
+	"""
+	Versions of the downloaded weights, kept in memory and saved to a JSON file.
+
+	Each model entry holds the S3 version, ETag and size of the verified
+	download, its download time and the status of the artifacts derived
+	from it (the TFLite exports). Reads are served from memory, reloaded
+	when another worker replaced the file. Updates re-read the file under
+	a lock shared by the workers, change a single entry and replace the
+	file with a rename, so concurrent workers neither lose each other's
+	updates nor leave a partial file behind.
+	"""
+
+	def __init__(self, path: str) -> None:
+		self.path = path
+		self._models: Dict[str, dict] = {}
+		self._file_id: Optional[tuple] = None
+		self._lock = threading.Lock()
+
+	def _stat(self) -> Optional[tuple]:
+		try:
+			stat = os.stat(self.path)
+		except OSError:
+			return None
+		# the inode changes on every rename, the mtime alone can be too coarse
+		return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+	def _read(self) -> Dict[str, dict]:
+		try:
+			with open(self.path, 'r') as json_file:
+				return json.load(json_file).get("models", {})
+		except FileNotFoundError:
+			return {}
+		except ValueError as e:
+			logger.warning("%s is not valid JSON, starting a new index: %s", self.path, e)
+			return {}
+
+	def _write(self, models: Dict[str, dict]) -> None:
+		temp_path = f"{self.path}.{os.getpid()}.tmp"
+		with open(temp_path, 'w') as json_file:
+			json.dump({"models": models}, json_file, indent=4)
+			json_file.flush()
+			os.fsync(json_file.fileno())
+		os.replace(temp_path, self.path)
+
+	def refresh(self) -> None:
+		"""Reload the index if the file changed since it was read."""
+		file_id = self._stat()
+		if file_id == self._file_id:
+			return
+		models = self._read()
+		with self._lock:
+			self._models, self._file_id = models, file_id
+
+	def _modify(self, model_name: str, modify: Callable[[dict], None]) -> dict:
+		os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+		with self._lock, file_lock(self.path + ".lock"):
+			models = self._read()
+			entry = dict(models.get(model_name, {}))
+			modify(entry)
+			models[model_name] = entry
+			self._write(models)
+			self._models, self._file_id = models, self._stat()
+		return dict(entry)
 
-	with open(settings.VERSIONS_PATH, 'r') as json_file:
-		data = json.load(json_file)
+	def get(self, model_name: str) -> dict:
+		"""Entry of a model, empty if its weights were never downloaded."""
+		self.refresh()
+		return dict(self._models.get(model_name, {}))
 
-	if model_name in data.get("models", {}):
-		return data["models"][model_name]["version"]
-	else:
-		return None
+	def entries(self) -> Dict[str, dict]:
+		self.refresh()
+		return {name: dict(entry) for name, entry in self._models.items()}
 
+	def version(self, model_name: str) -> Optional[str]:
+		return self.get(model_name).get("version")
 
+	def update(self, model_name: str, **fields) -> dict:
+		"""Set fields of the entry of a model, keeping the others."""
+		return self._modify(model_name, lambda entry: entry.update(fields))
+
+	def record_download(self, model_name: str, version: str, etag: Optional[str], size: Optional[int]) -> dict:
+		"""
+		Record a verified download. It replaces the whole entry: the
+		artifacts of the previous weights are stale.
+		"""
+		def _replace(entry: dict) -> None:
+			entry.clear()
+			entry.update(version=version, etag=etag, size=size, downloaded_at=time.time(), artifacts={})
+		return self._modify(model_name, _replace)
+
+	def set_artifact(self, model_name: str, artifact: str, **status) -> None:
+		"""
+		Record the status of an artifact derived from the weights of a
+		model, e.g. ``set_artifact("tomato", "tflite", status="ready")``.
+		The file is only written when the status changed.
+		"""
+		if self.get(model_name).get("artifacts", {}).get(artifact) == status:
+			return
+		def _set(entry: dict) -> None:
+			entry.setdefault("artifacts", {})[artifact] = status
+		self._modify(model_name, _set)
+
+
+version_index = ModelVersionIndex(settings.VERSIONS_PATH)
+
+
+def initialize_model_version()->None:
+	if not os.path.exists(settings.WEIGHTS_DIR):
+		os.makedirs(settings.WEIGHTS_DIR, exist_ok=True)
+
+	version_index.refresh()
+
+def get_model_version(model_name: str) -> str | None:
+	return version_index.version(model_name)
@@ -0,0 +1,219 @@
+"""
+Offline stand-ins for the benchmark: synthetic photos, a tiny Keras
+model and a local HTTP server playing both the presigned image URLs
+and the S3 weights bucket.
+"""
+import os
+import json
+import hashlib
+import asyncio
+import threading
+from xml.sax.saxutils import escape
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from aiohttp import web
+
+WEIGHTS_BUCKET = "benchmark-weights"
+IMAGES_BUCKET = "benchmark-images"
+MODEL_NAME = "benchmark"
+NUM_CLASSES = 8
+
+
+def synthetic_jpeg(width: int, height: int, seed: int, quality: int = 90) -> bytes:
+    """
+    Encode a photo-like JPEG: smooth colour regions plus sensor noise,
+    so it compresses to about the size of a real photo of that resolution.
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((max(2, height // 64), max(2, width // 64), 3)) * 255
+    image = Image.fromarray(coarse.astype(np.uint8)).resize((width, height), Image.BICUBIC)
+    pixels = np.asarray(image, dtype=np.int16) + rng.integers(-12, 13, (height, width, 3), dtype=np.int16)
+    buffer = BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def generate_images(sizes: List[Tuple[int, int]], per_size: int) -> Dict[str, bytes]:
+    """
+    :param sizes: (width, height) of the images.
+    :param per_size: number of distinct images of each size.
+    :return: JPEG bytes by object key.
+    """
+    images = {}
+    for width, height in sizes:
+        for index in range(per_size):
+            images[f"{width}x{height}/{index}.jpg"] = synthetic_jpeg(width, height, seed=len(images))
+    return images
+
+
+def build_model(path: str, input_size: int = 299) -> None:
+    """Save a small CNN with the input and output layout of the served models."""
+    import keras
+
+    model = keras.Sequential([
+        keras.Input((input_size, input_size, 3)),
+        keras.layers.Conv2D(16, 3, strides=2, activation="relu"),
+        keras.layers.Conv2D(32, 3, strides=2, activation="relu"),
+        keras.layers.Conv2D(64, 3, strides=2, activation="relu"),
+        keras.layers.GlobalAveragePooling2D(),
+        keras.layers.Dense(NUM_CLASSES, activation="softmax"),
+    ])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    model.save(path)
+
+
+def prepare_bucket(root: str) -> str:
+    """
+    Lay out the weights bucket served by the stub: classes.json and the model.
+
+    :param root: benchmark working directory.
+    :return: directory holding the buckets.
+    """
+    buckets_dir = os.path.join(root, "s3")
+    bucket_dir = os.path.join(buckets_dir, WEIGHTS_BUCKET)
+    model_path = os.path.join(bucket_dir, "models", MODEL_NAME, f"{MODEL_NAME}_model.h5")
+    if not os.path.exists(model_path):
+        build_model(model_path)
+    classes = {MODEL_NAME: {str(index): f"disease_{index}" for index in range(NUM_CLASSES)}}
+    with open(os.path.join(bucket_dir, "classes.json"), "w") as classes_file:
+        json.dump(classes, classes_file)
+    return buckets_dir
+
+
+def _byte_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    if not header or not header.startswith("bytes="):
+        return None
+    start, _, end = header[len("bytes="):].partition("-")
+    if not start:
+        return max(0, size - int(end)), size - 1
+    return int(start), min(int(end), size - 1) if end else size - 1
+
+
+class StubServer:
+    """
+    Local HTTP server standing in for S3, run on its own event loop thread.
+
+    Objects are served path-style from ``/<bucket>/<key>``: the images
+    kept in memory and the files of ``buckets_dir``. HEAD, byte ranges,
+    If-Match, If-None-Match and ``partNumber`` are supported, with the
+    ETags S3 reports for single-part and multipart uploads, so the weights
+    download path runs unchanged against it by pointing AWS_ENDPOINT_URL
+    at ``url``.
+    Buckets are listed with ListObjectsV2 and ListObjectVersions, as an
+    unversioned bucket (every version id is ``null``).
+    """
+
+    def __init__(self, images: Dict[str, bytes], buckets_dir: Optional[str] = None,
+                 multipart_size: Optional[int] = None) -> None:
+        self.images = images
+        self.buckets_dir = buckets_dir
+        # objects larger than this are reported as multipart uploads
+        self.multipart_size = multipart_size
+        self.url: Optional[str] = None
+        self._loop = asyncio.new_event_loop()
+        self._runner: Optional[web.AppRunner] = None
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    def image_url(self, key: str) -> str:
+        return f"{self.url}/{IMAGES_BUCKET}/{key}"
+
+    def _object(self, bucket: str, key: str) -> Optional[bytes]:
+        if bucket == IMAGES_BUCKET:
+            return self.images.get(key)
+        if self.buckets_dir is None:
+            return None
+        path = os.path.realpath(os.path.join(self.buckets_dir, bucket, key))
+        if not path.startswith(os.path.realpath(self.buckets_dir)) or not os.path.isfile(path):
+            return None
+        with open(path, "rb") as object_file:
+            return object_file.read()
+
+    def _etag(self, body: bytes) -> str:
+        if not self.multipart_size or len(body) <= self.multipart_size:
+            return hashlib.md5(body).hexdigest()
+        parts = [body[start:start + self.multipart_size] for start in range(0, len(body), self.multipart_size)]
+        digests = b"".join(hashlib.md5(part).digest() for part in parts)
+        return f"{hashlib.md5(digests).hexdigest()}-{len(parts)}"
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        body = self._object(request.match_info["bucket"], request.match_info["key"])
+        if body is None:
+            return web.Response(status=404)
+        etag = f'"{self._etag(body)}"'
+        if request.headers.get("If-Match", etag) != etag:
+            return web.Response(status=412)
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        byte_range = _byte_range(request.headers.get("Range"), len(body))
+        part_number = request.query.get("partNumber")
+        if part_number and self.multipart_size and len(body) > self.multipart_size:
+            start = (int(part_number) - 1) * self.multipart_size
+            byte_range = (start, min(start + self.multipart_size, len(body)) - 1)
+            headers["x-amz-mp-parts-count"] = str(-(-len(body) // self.multipart_size))
+        if byte_range is None:
+            return web.Response(body=body, headers=headers, content_type="application/octet-stream")
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+        return web.Response(status=206, body=body[start:end + 1], headers=headers, content_type="application/octet-stream")
+
+    def _keys(self, bucket: str, prefix: str) -> List[str]:
+        if bucket == IMAGES_BUCKET:
+            keys = list(self.images)
+        elif self.buckets_dir is None or not os.path.isdir(os.path.join(self.buckets_dir, bucket)):
+            return []
+        else:
+            bucket_dir = os.path.join(self.buckets_dir, bucket)
+            keys = [
+                os.path.relpath(os.path.join(directory, name), bucket_dir).replace(os.sep, "/")
+                for directory, _, names in os.walk(bucket_dir) for name in names
+            ]
+        return sorted(key for key in keys if key.startswith(prefix))
+
+    async def _list(self, request: web.Request) -> web.Response:
+        bucket = request.match_info["bucket"]
+        prefix = request.query.get("prefix", "")
+        versions = "versions" in request.query
+        entries = []
+        for key in self._keys(bucket, prefix):
+            body = self._object(bucket, key)
+            fields = f"<Key>{escape(key)}</Key><ETag>&quot;{self._etag(body)}&quot;</ETag><Size>{len(body)}</Size>" \
+                     f"<LastModified>2024-01-01T00:00:00.000Z</LastModified>"
+            if versions:
+                entries.append(f"<Version>{fields}<VersionId>null</VersionId><IsLatest>true</IsLatest></Version>")
+            else:
+                entries.append(f"<Contents>{fields}</Contents>")
+        root = "ListVersionsResult" if versions else "ListBucketResult"
+        count = "" if versions else f"<KeyCount>{len(entries)}</KeyCount>"
+        body = (
+            f'<?xml version="1.0" encoding="UTF-8"?><{root} xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>{count}<IsTruncated>false</IsTruncated>"
+            f"{''.join(entries)}</{root}>"
+        )
+        return web.Response(body=body.encode(), content_type="application/xml")
+
+    async def _start(self, host: str, port: int) -> None:
+        app = web.Application()
+        app.router.add_get("/{bucket}", self._list)
+        app.router.add_get("/{bucket}/", self._list)
+        app.router.add_get("/{bucket}/{key:.+}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(host, port), self._loop).result()
+        return self.url
+
+    def stop(self) -> None:
+        if self._runner is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,461 @@
+"""
+Latency and throughput benchmark of the inference path, runnable offline.
+
+Synthetic JPEGs and a tiny generated Keras model are served by a local
+stub standing in for S3 and the presigned image URLs. Two benchmarks
+are run:
+
+- stages: the fetch, decode, preprocess, predict and postprocess stages
+  timed one by one in process, per image size.
+- load: the real server started with ``python -m app`` for each worker
+  count and per-worker thread count, driven with /api/inference/predict
+  at each concurrency level. The best configuration is reported.
+
+With ``--draft-parity``, the predictions of JPEGs decoded in draft mode
+are also checked against full resolution decodes, failing the run when
+they differ by more than ``--max-draft-diff``.
+
+Results are written as JSON, for comparison between runs:
+
+    python -m benchmarks.inference --workers 1 2 --concurrency 1 8 32 --output results.json
+    python -m benchmarks.inference --workers 1 2 4 --threads 1 2 4 --concurrency 32 --skip-stages
+    python -m benchmarks.inference --skip-load --skip-stages --draft-parity
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Dict, List, Optional
+
+import aiohttp
+import numpy as np
+
+from benchmarks.fixtures import (
+    IMAGES_BUCKET, MODEL_NAME, WEIGHTS_BUCKET, StubServer, generate_images, prepare_bucket,
+)
+
+logger = logging.getLogger("benchmarks.inference")
+
+STAGES = ("fetch", "decode", "preprocess", "predict", "postprocess")
+
+
+def summarize(samples: List[float]) -> dict:
+    """
+    :param samples: durations in seconds.
+    :return: count, mean and percentiles in milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def app_environment(workdir: str, stub_url: str, overrides: Dict[str, str]) -> Dict[str, str]:
+    """Environment running the app against the stub, in its own weights dir."""
+    weights_dir = os.path.join(workdir, "weights")
+    env = {
+        "ML_APIS_AWS_DEFAULT_REGION": "us-east-1",
+        "ML_APIS_AWS_ACCESS_KEY_ID": "benchmark",
+        "ML_APIS_AWS_SECRET_ACCESS_KEY": "benchmark",
+        "ML_APIS_AWS_WEIGHTS_BUCKET_NAME": WEIGHTS_BUCKET,
+        "ML_APIS_AWS_IMAGES_BUCKET_NAME": IMAGES_BUCKET,
+        "ML_APIS_AWS_ENDPOINT_URL": stub_url,
+        "ML_APIS_WEIGHTS_DIR": weights_dir,
+        "ML_APIS_VERSIONS_PATH": os.path.join(weights_dir, "versions.json"),
+        "ML_APIS_RELOAD_EVENTS_PATH": os.path.join(weights_dir, "reload_events.json"),
+        # the same images are sent over and over, cache hits would skip the stages
+        "ML_APIS_PREDICTION_CACHE_SIZE": "0",
+        "ML_APIS_IMAGE_CACHE_MAX_BYTES": "0",
+        "TF_CPP_MIN_LOG_LEVEL": "3",
+    }
+    env.update(overrides)
+    return env
+
+
+async def run_stage_benchmark(stub: StubServer, keys_by_size: Dict[str, List[str]], iterations: int) -> dict:
+    """
+    Time each stage of one request, in process.
+
+    Must run after the app environment was set, the app reads its
+    settings at import.
+    """
+    from app.core.config import settings
+    from app.utils.http_utils import http_client
+    from app.utils.s3_utils import s3_client
+    from app.utils.image_utils import load_image, preprocess_image, BatchBuffer
+    from app.utils.model_utils import load_classes, model_manager
+    from app.services.postprocessing import postprocess_batch
+
+    target_size = (299, 299)
+    await http_client.start()
+    try:
+        await load_classes()
+        await model_manager._load_model_from_s3(MODEL_NAME)
+        model = model_manager.loaded_models[MODEL_NAME]
+        buffer = BatchBuffer(1, target_size)
+        results = {}
+        for size, keys in keys_by_size.items():
+            timings = {stage: [] for stage in STAGES}
+            for iteration in range(iterations):
+                url = stub.image_url(keys[iteration % len(keys)])
+                started = time.perf_counter()
+                data = await http_client.fetch_bytes(url, settings.IMAGE_MAX_BYTES)
+                fetched = time.perf_counter()
+                image = load_image(data, target_size)
+                image.load()
+                decoded = time.perf_counter()
+                preprocessed = preprocess_image(image, target_size)
+                preprocessed_at = time.perf_counter()
+                predictions = model.predict(buffer.fill([preprocessed]), batch_size=1, verbose=0)
+                predicted = time.perf_counter()
+                postprocess_batch(predictions, model_manager.class_labels[MODEL_NAME])
+                done = time.perf_counter()
+                for stage, duration in zip(STAGES, (
+                    fetched - started, decoded - fetched, preprocessed_at - decoded,
+                    predicted - preprocessed_at, done - predicted,
+                )):
+                    timings[stage].append(duration)
+            results[size] = {
+                "image_bytes": int(np.mean([len(stub.images[key]) for key in keys])),
+                **{stage: summarize(samples) for stage, samples in timings.items()},
+            }
+            logger.info("stages %s: %s", size, {stage: results[size][stage]["p50_ms"] for stage in STAGES})
+        return results
+    finally:
+        await http_client.close()
+        await s3_client.close()
+
+
+def run_draft_parity(model_path: str, images: Dict[str, bytes]) -> dict:
+    """
+    Compare the predictions of JPEGs decoded in draft mode (at a reduced
+    scale, as served) with those of full resolution decodes.
+
+    Must run after the app environment was set, the app reads its
+    settings at import.
+
+    :param model_path: Keras model run over both decodes.
+    :param images: encoded images by name.
+    :return: top-1 agreement and prediction differences.
+    """
+    import keras
+    from app.utils.image_utils import load_image, preprocess_image, BatchBuffer
+
+    model = keras.models.load_model(model_path)
+    target_size = tuple(model.input_shape[1:3])
+    full, draft = [], []
+    for data in images.values():
+        full.append(preprocess_image(load_image(data), target_size))
+        draft.append(preprocess_image(load_image(data, target_size), target_size))
+    reference = np.asarray(model.predict(BatchBuffer(len(full), target_size).fill(full), verbose=0))
+    outputs = np.asarray(model.predict(BatchBuffer(len(draft), target_size).fill(draft), verbose=0))
+    difference = np.abs(outputs - reference)
+    result = {
+        "images": len(images),
+        "top1_agreement": float(np.mean(np.argmax(outputs, axis=-1) == np.argmax(reference, axis=-1))),
+        "mean_abs_diff": float(difference.mean()),
+        "max_abs_diff": float(difference.max()),
+    }
+    logger.info("draft decode parity: %s", result)
+    return result
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(env: Dict[str, str], workers: int, port: int, log_path: str) -> subprocess.Popen:
+    server_env = dict(os.environ)
+    server_env.update(env)
+    server_env.update({
+        "ML_APIS_reload": "False",
+        "ML_APIS_workers_count": str(workers),
+        "ML_APIS_host": "127.0.0.1",
+        "ML_APIS_port": str(port),
+    })
+    with open(log_path, "ab") as log_file:
+        return subprocess.Popen(
+            [sys.executable, "-m", "app"], env=server_env,
+            stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True,
+        )
+
+
+def stop_server(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+async def wait_ready(session: aiohttp.ClientSession, base_url: str, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            async with session.get(f"{base_url}/api/healthcheck/ready") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"Server not ready after {timeout}s")
+
+
+async def drive_load(
+    session: aiohttp.ClientSession, base_url: str, urls: List[str], concurrency: int, requests: int,
+) -> dict:
+    """
+    Send ``requests`` predictions, ``concurrency`` at a time.
+
+    Clients wait for the Retry-After of a shed request before sending
+    their next one, like well-behaved callers.
+
+    :return: throughput, latency percentiles of the successes and of
+        the failures, and errors by status code.
+    """
+    latencies: List[float] = []
+    error_latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    next_request = iter(range(requests))
+
+    async def _client() -> None:
+        for index in next_request:
+            payload = {"model_name": MODEL_NAME, "presigned_url": urls[index % len(urls)]}
+            started = time.perf_counter()
+            retry_after = None
+            try:
+                async with session.post(f"{base_url}/api/inference/predict", json=payload) as response:
+                    await response.read()
+                    status = response.status
+                    retry_after = response.headers.get("Retry-After")
+            except aiohttp.ClientError as e:
+                status = type(e).__name__
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                error_latencies.append(time.perf_counter() - started)
+                errors[str(status)] = errors.get(str(status), 0) + 1
+            if retry_after:
+                await asyncio.sleep(float(retry_after))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[_client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2),
+        "latency": summarize(latencies),
+        "error_latency": summarize(error_latencies),
+        "errors": errors,
+    }
+
+
+def thread_environment(threads: int) -> Dict[str, str]:
+    """Settings giving every worker ``threads`` threads, 0 sizes them to its cores."""
+    return {
+        "ML_APIS_TF_INTRA_OP_THREADS": str(threads),
+        "ML_APIS_RUNTIME_NUM_THREADS": str(threads),
+    }
+
+
+async def run_load_benchmark(
+    env: Dict[str, str],
+    urls: List[str],
+    worker_counts: List[int],
+    concurrency_levels: List[int],
+    requests: int,
+    warmup: int,
+    workdir: str,
+    ready_timeout: float,
+    thread_counts: Optional[List[int]] = None,
+) -> List[dict]:
+    """
+    Run the load benchmark for every worker count x thread count.
+
+    :param thread_counts: threads per worker, None keeps the settings of ``env``.
+    """
+    results = []
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for workers in worker_counts:
+            for threads in thread_counts or [None]:
+                server_env = dict(env, **thread_environment(threads)) if threads is not None else env
+                port = _free_port()
+                base_url = f"http://127.0.0.1:{port}"
+                suffix = f"_{threads}t" if threads is not None else ""
+                log_path = os.path.join(workdir, f"server_{workers}w{suffix}.log")
+                process = start_server(server_env, workers, port, log_path)
+                try:
+                    await wait_ready(session, base_url, process, ready_timeout)
+                    # every worker loads and traces the model on its first requests
+                    await drive_load(session, base_url, urls, max(concurrency_levels), warmup * workers)
+                    for concurrency in concurrency_levels:
+                        result = await drive_load(session, base_url, urls, concurrency, requests)
+                        result["workers"] = workers
+                        result["threads"] = threads
+                        results.append(result)
+                        logger.info(
+                            "load workers=%d threads=%s concurrency=%d: %.1f rps, p50 %s ms, p99 %s ms, errors %s",
+                            workers, "auto" if not threads else threads, concurrency, result["rps"],
+                            result["latency"].get("p50_ms"), result["latency"].get("p99_ms"), result["errors"],
+                        )
+                finally:
+                    stop_server(process)
+    return results
+
+
+def best_configurations(results: List[dict]) -> Dict[int, dict]:
+    """Highest throughput workers x threads configuration, per concurrency level."""
+    best: Dict[int, dict] = {}
+    for result in results:
+        current = best.get(result["concurrency"])
+        if current is None or result["rps"] > current["rps"]:
+            best[result["concurrency"]] = {key: result[key] for key in ("workers", "threads", "rps")}
+            best[result["concurrency"]]["p99_ms"] = result["latency"].get("p99_ms")
+    return best
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_size(value: str) -> tuple:
+    width, _, height = value.partition("x")
+    return int(width), int(height)
+
+
+def _parse_env(value: str) -> tuple:
+    key, _, item = value.partition("=")
+    if not key.startswith("ML_APIS_"):
+        key = "ML_APIS_" + key
+    return key, item
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="gunicorn worker counts")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        help="threads per worker to sweep (TensorFlow intra-op and TFLite), 0 for its cores")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=20, help="warm-up requests per worker")
+    parser.add_argument("--stage-iterations", type=int, default=30, help="timed requests per image size")
+    parser.add_argument("--image-sizes", type=_parse_size, nargs="+",
+                        default=[(640, 480), (1280, 960), (2048, 1536), (4032, 3024)])
+    parser.add_argument("--images-per-size", type=int, default=4)
+    parser.add_argument("--env", type=_parse_env, action="append", default=[],
+                        help="app setting override, e.g. --env OPTIMIZED_RUNTIME=False")
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-load", action="store_true")
+    parser.add_argument("--draft-parity", action="store_true",
+                        help="check the predictions of draft JPEG decodes against full decodes")
+    parser.add_argument("--max-draft-diff", type=float, default=0.05,
+                        help="largest accepted difference of a draft decode prediction")
+    parser.add_argument("--parity-model", help="Keras model of the parity check, instead of the generated one")
+    parser.add_argument("--parity-images", help="directory of JPEGs for the parity check, instead of the generated ones")
+    parser.add_argument("--ready-timeout", type=float, default=180)
+    parser.add_argument("--workdir", help="keep the weights and server logs there, instead of a temp dir")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ml-api-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+
+    images = generate_images(args.image_sizes, args.images_per_size)
+    keys_by_size: Dict[str, List[str]] = {}
+    for key in images:
+        keys_by_size.setdefault(key.split("/")[0], []).append(key)
+    buckets_dir = prepare_bucket(workdir)
+    stub = StubServer(images, buckets_dir)
+    stub.start()
+    env = app_environment(workdir, stub.url, dict(args.env))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "settings": {key: value for key, value in env.items() if key.startswith("ML_APIS_") and "AWS" not in key},
+            "args": {key: value for key, value in vars(args).items() if key != "env"},
+        },
+    }
+    try:
+        if not args.skip_load:
+            urls = [stub.image_url(key) for key in images]
+            report["load"] = asyncio.run(run_load_benchmark(
+                env, urls, args.workers, args.concurrency, args.requests, args.warmup, workdir, args.ready_timeout,
+                args.threads,
+            ))
+            report["best"] = best_configurations(report["load"])
+            for concurrency, best in report["best"].items():
+                logger.info(
+                    "best at concurrency=%d: workers=%d threads=%s, %.1f rps",
+                    concurrency, best["workers"], best["threads"] or "auto", best["rps"],
+                )
+        if not args.skip_stages:
+            # after the load runs, this imports TensorFlow in the client process
+            os.environ.update(env)
+            report["stages"] = asyncio.run(run_stage_benchmark(stub, keys_by_size, args.stage_iterations))
+        if args.draft_parity:
+            os.environ.update(env)
+            parity_images = images
+            if args.parity_images:
+                parity_images = {}
+                for name in sorted(os.listdir(args.parity_images)):
+                    if name.lower().endswith((".jpg", ".jpeg")):
+                        with open(os.path.join(args.parity_images, name), "rb") as image_file:
+                            parity_images[name] = image_file.read()
+            model_path = args.parity_model or os.path.join(
+                buckets_dir, WEIGHTS_BUCKET, "models", MODEL_NAME, f"{MODEL_NAME}_model.h5",
+            )
+            report["draft_parity"] = run_draft_parity(model_path, parity_images)
+    finally:
+        stub.stop()
+
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2, default=str)
+    logger.info("Results written to %s, server logs in %s", args.output, workdir)
+
+    parity = report.get("draft_parity")
+    if parity is not None and parity["max_abs_diff"] > args.max_draft_diff:
+        logger.error(
+            "Draft decode predictions differ by up to %.3g, more than %.3g",
+            parity["max_abs_diff"], args.max_draft_diff,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()